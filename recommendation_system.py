@@ -4,16 +4,38 @@ Recommendation System for Online Marketplace
 Full implementation with terminal interface - FIXED VERSION
 """
 
+import argparse
+import asyncio
+import bisect
 import json
 import hashlib
+import heapq
 import os
+import pickle
 import random
+import re
+import sqlite3
+import sys
 import threading
 import time
+import zipfile
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
 from datetime import datetime, timedelta
-from typing import Dict, List, Tuple
+from functools import partial
+from itertools import chain, count, islice, repeat
+from xml.etree import ElementTree
+from typing import Dict, List, Set, Tuple
+import numpy as np
 import openpyxl
 
+try:
+    import fcntl
+except ImportError:  # Windows: advisory file locking is skipped
+    fcntl = None
+
 
 AGE_MODIFIERS = {
     "0-13": {
@@ -228,25 +250,34 @@ DELIVERY_CRITERIA = ["1day", "2-3days", "4+days"]
 
 SPHERE_DECAY_CONFIG = {
     "next_decay_time": {},
-    "cancel_decay_flags": {},
     "base_interval": 20 * 60,
     "purchase_interval": 10 * 60,
-    "decay_lock": threading.Lock(),
+    "sphere_locks": {},
     "background_thread": None,
+    "scheduler": None,
     "products_ref": None,
+    "epoch": 0,
 }
 
+PROFILE_VERSIONS = count(1)
+DECAY_EPOCHS = count(1)
+
+SNAPSHOT_VERSION = 3
+
+EXCEL_IMPORT_PATH = "IA_COMP_EXPANDED.xlsx"
+
 MAX_SPHERE_SCORE = 5.0
 MAX_CRITERIA_SCORE = 3.0
 MAX_TAG_SCORE = 3.0
 MAX_TYPE_SCORE = 3.0
 
 
-def get_seasonal_bonus(sphere: str) -> float:
+def get_seasonal_bonus(sphere: str, month: int = None) -> float:
     """
     FIXED: Increased seasonal effects for more noticeable impact
     """
-    month = datetime.now().month
+    if month is None:
+        month = datetime.now().month
     
     if month in [12, 1, 2]:
         if sphere == "Clothing and Footwear":
@@ -265,70 +296,267 @@ def get_seasonal_bonus(sphere: str) -> float:
     return 1.0
 
 
-def check_sphere_decay(products: List[Dict], sphere: str) -> bool:
+class DecayState:
+    """
+    Decay engine state kept apart from the products: the decay multiplier of
+    each decayed product, by product id. Products never decayed are not
+    stored and read as 1.0, so memory follows the number of decayed products
+    rather than the largest id. gather() looks many ids up at once through a
+    sorted copy of the map, rebuilt after a change.
+    Each ProductCatalog owns one. Once persist_to() names a file, every
+    change submits a save to a WriteCoalescer, so a crash loses at most the
+    coalescer's delay of decay state.
+    """
+    
+    FORMAT_VERSION = 3
+    
+    def __init__(self):
+        self.multipliers: Dict[int, float] = {}
+        self._sorted = None  # (ids, multipliers) arrays sorted by id, None when stale
+        self._lock = threading.Lock()
+        self._path = None
+        self._writer = None
+    
+    def persist_to(self, path: str, writer: 'WriteCoalescer' = None):
+        """Save to path from now on, through writer (default: a WriteCoalescer of its own)"""
+        self._path = path
+        self._writer = writer if writer is not None else WriteCoalescer(delay=1.0)
+    
+    def _changed(self):
+        self._sorted = None
+        if self._writer is not None:
+            self._writer.submit(self._path, partial(self.save, self._path))
+    
+    def flush(self):
+        """Write a pending save now"""
+        if self._writer is not None:
+            self._writer.flush(self._path)
+    
+    def multiplier(self, product_id: int) -> float:
+        return self.multipliers.get(product_id, 1.0)
+    
+    def set_multiplier(self, product_id: int, value: float):
+        with self._lock:
+            if value == 1.0:
+                self.multipliers.pop(product_id, None)
+            else:
+                self.multipliers[product_id] = value
+            self._changed()
+    
+    def forget(self, product_id: int):
+        """Reset a product that left the catalog"""
+        with self._lock:
+            if self.multipliers.pop(product_id, None) is not None:
+                self._changed()
+    
+    def gather(self, product_ids: np.ndarray) -> np.ndarray:
+        """Decay multipliers for an array of product ids"""
+        result = np.ones(len(product_ids))
+        with self._lock:
+            if not self.multipliers:
+                return result
+            if self._sorted is None:
+                ids = np.fromiter(self.multipliers, dtype=np.int64, count=len(self.multipliers))
+                values = np.fromiter(self.multipliers.values(), dtype=np.float64, count=len(ids))
+                order = np.argsort(ids)
+                self._sorted = ids[order], values[order]
+            ids, values = self._sorted
+        
+        positions = np.minimum(np.searchsorted(ids, product_ids), len(ids) - 1)
+        known = ids[positions] == product_ids
+        result[known] = values[positions[known]]
+        return result
+    
+    def adopt_legacy(self, decay_scores: Dict[int, float]):
+        """Take over decay_score values (by product id) that older versions stored on product dicts"""
+        for product_id, decay_score in decay_scores.items():
+            if self.multiplier(product_id) == 1.0:
+                self.set_multiplier(product_id, decay_score)
+    
+    def save(self, path: str):
+        with self._lock:
+            data = pickle.dumps({"version": self.FORMAT_VERSION, "multipliers": dict(self.multipliers)},
+                                protocol=pickle.HIGHEST_PROTOCOL)
+        atomic_write(path, data)
+    
+    def load(self, path: str) -> bool:
+        """Replace the state with the one saved at path; False if none is readable"""
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            if state["version"] == self.FORMAT_VERSION:
+                multipliers = dict(state["multipliers"])
+            elif state["version"] in (1, 2):
+                # arrays indexed by product id, with 1.0 for undecayed products
+                multipliers = {product_id: value for product_id, value in enumerate(state["multipliers"])
+                               if value != 1.0}
+            else:
+                return False
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+            return False
+        
+        with self._lock:
+            self.multipliers = multipliers
+            self._sorted = None
+        return True
+
+
+def _neutral_user() -> 'User':
+    """
+    Profile with no demographics or history, for rankings that must not
+    depend on any one user: criteria preferences averaged over the
+    locations, every sphere, tag and type at the 0.1 default.
+    """
+    criteria = {
+        criterion: sum(modifiers[criterion] for modifiers in LOCATION_MODIFIERS.values()) / len(LOCATION_MODIFIERS)
+        for criterion in LOCATION_MODIFIERS["big_city"]
+    }
+    return User.from_dict({
+        "username": "", "password_hash": "", "age": 0, "gender": "", "location": "", "balance": 0,
+        "sphere_scores": {}, "criteria_scores": criteria, "initial_influence": 1.0,
+    })
+
+
+def _sphere_lock(sphere: str) -> threading.Lock:
+    """Lock guarding one sphere's decay deadline and decay multipliers"""
+    lock = SPHERE_DECAY_CONFIG["sphere_locks"].get(sphere)
+    if lock is None:
+        lock = SPHERE_DECAY_CONFIG["sphere_locks"].setdefault(sphere, threading.Lock())
+    return lock
+
+
+def _schedule_decay(sphere: str, due: float) -> None:
+    """Queue the decay time set for sphere with the background scheduler, if running"""
+    scheduler = SPHERE_DECAY_CONFIG["scheduler"]
+    if scheduler is not None:
+        scheduler.push(sphere, due)
+
+
+def check_sphere_decay(products: 'ProductCatalog', sphere: str) -> bool:
     """
     FIXED: Corrected decay formula logic
+    Decays the product with the sphere's 3rd highest score for a neutral
+    profile (decay applied, so repeated steps move down the ranking). It is
+    found without holding any lock; the decay is applied only if no purchase
+    rescheduled the sphere in the meantime.
     """
-    with SPHERE_DECAY_CONFIG["decay_lock"]:
+    lock = _sphere_lock(sphere)
+    with lock:
         current_time = datetime.now().timestamp()
         next_decay = SPHERE_DECAY_CONFIG["next_decay_time"].get(sphere, 0)
         
         if current_time < next_decay:
             return False
-        
-        if SPHERE_DECAY_CONFIG["cancel_decay_flags"].get(sphere, False):
-            SPHERE_DECAY_CONFIG["cancel_decay_flags"][sphere] = False
-            SPHERE_DECAY_CONFIG["next_decay_time"][sphere] = current_time + SPHERE_DECAY_CONFIG["purchase_interval"]
-            return False
-        
-        sphere_products = [p for p in products if p.get("sphere") == sphere]
-        
-        if len(sphere_products) < 3:
-            SPHERE_DECAY_CONFIG["next_decay_time"][sphere] = current_time + SPHERE_DECAY_CONFIG["base_interval"]
-            return False
-        
-        sphere_products_sorted = sorted(sphere_products, key=lambda p: p.get("_score", 0), reverse=True)
-        product_3rd = sphere_products_sorted[2]
-        
-        if "decay_score" not in product_3rd:
-            product_3rd["decay_score"] = 1.0
-        
-        if SPHERE_DECAY_CONFIG["cancel_decay_flags"].get(sphere, False):
-            SPHERE_DECAY_CONFIG["cancel_decay_flags"][sphere] = False
-            SPHERE_DECAY_CONFIG["next_decay_time"][sphere] = current_time + SPHERE_DECAY_CONFIG["purchase_interval"]
+    
+    matrix = products.matrix()
+    rows = matrix.sphere_rows(sphere)
+    product_3rd = None
+    if len(rows) >= 3:
+        neutral = _neutral_user()
+        scores = matrix.score(neutral, ScoringContext(neutral, decay=products.decay), rows=rows)
+        product_3rd = matrix.products[top_rows(rows, scores, 3)[2]]
+    
+    with lock:
+        if SPHERE_DECAY_CONFIG["next_decay_time"].get(sphere, 0) != next_decay:
             return False
         
-        old_score = product_3rd["decay_score"]
-        new_score = max(old_score * 0.9, 0.3)  # Never go below 0.3
-        product_3rd["decay_score"] = new_score
+        if product_3rd is not None:
+            old_score = products.decay.multiplier(product_3rd["id"])
+            new_score = max(old_score * 0.9, 0.3)  # Never go below 0.3
+            products.decay.set_multiplier(product_3rd["id"], new_score)
+            SPHERE_DECAY_CONFIG["epoch"] = next(DECAY_EPOCHS)
         
-        SPHERE_DECAY_CONFIG["next_decay_time"][sphere] = current_time + SPHERE_DECAY_CONFIG["base_interval"]
-        return True
+        due = current_time + SPHERE_DECAY_CONFIG["base_interval"]
+        SPHERE_DECAY_CONFIG["next_decay_time"][sphere] = due
+    _schedule_decay(sphere, due)
+    return product_3rd is not None
 
 
 def cancel_sphere_decay(sphere: str) -> None:
     """Cancel next decay for sphere on purchase"""
-    with SPHERE_DECAY_CONFIG["decay_lock"]:
-        current_time = datetime.now().timestamp()
-        SPHERE_DECAY_CONFIG["cancel_decay_flags"][sphere] = True
-        SPHERE_DECAY_CONFIG["next_decay_time"][sphere] = current_time + SPHERE_DECAY_CONFIG["purchase_interval"]
+    with _sphere_lock(sphere):
+        due = datetime.now().timestamp() + SPHERE_DECAY_CONFIG["purchase_interval"]
+        SPHERE_DECAY_CONFIG["next_decay_time"][sphere] = due
+    _schedule_decay(sphere, due)
 
 
-def start_decay_background_task(products: List[Dict], all_spheres: List[str]) -> None:
-    """Start background decay process"""
-    SPHERE_DECAY_CONFIG["products_ref"] = products
+class DecayScheduler:
+    """
+    Runs check_sphere_decay for each sphere when its next decay time comes due.
+    Keeps a heap of (due time, sphere) and sleeps until the earliest one;
+    rescheduling pushes a new entry and wakes the thread, and entries that no
+    longer match next_decay_time are discarded when they reach the top.
+    The heap has its own lock, held only for queue operations, never for a scan.
+    """
+    
+    def __init__(self, products: 'ProductCatalog', spheres: List[str]):
+        self.products = products
+        self._condition = threading.Condition()
+        self._heap = []
+        self._stopped = False
+        self._thread = None
+        
+        for sphere in spheres:
+            heapq.heappush(self._heap, (SPHERE_DECAY_CONFIG["next_decay_time"].get(sphere, 0), sphere))
+    
+    def push(self, sphere: str, due: float):
+        """Queue sphere for due and wake the scheduler thread"""
+        with self._condition:
+            heapq.heappush(self._heap, (due, sphere))
+            if len(self._heap) > 2 * len(SPHERE_DECAY_CONFIG["next_decay_time"]) + 64:
+                self._heap = [(d, s) for s, d in list(SPHERE_DECAY_CONFIG["next_decay_time"].items())]
+                heapq.heapify(self._heap)
+            self._condition.notify()
+    
+    def start(self) -> threading.Thread:
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self._thread
+    
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+    
+    def _next_due(self):
+        """Wait for the earliest live deadline and pop its sphere (None once stopped)"""
+        with self._condition:
+            while not self._stopped:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                
+                due, sphere = self._heap[0]
+                if SPHERE_DECAY_CONFIG["next_decay_time"].get(sphere, 0) != due:
+                    heapq.heappop(self._heap)
+                    continue
+                
+                delay = due - datetime.now().timestamp()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                
+                heapq.heappop(self._heap)
+                return sphere
+        return None
     
-    def background_decay_loop():
+    def _run(self):
         while True:
-            time.sleep(10)
-            
-            for sphere in all_spheres:
-                if SPHERE_DECAY_CONFIG["next_decay_time"].get(sphere, 0) <= datetime.now().timestamp():
-                    check_sphere_decay(products, sphere)
+            sphere = self._next_due()
+            if sphere is None:
+                return
+            check_sphere_decay(self.products, sphere)
+
+
+def start_decay_background_task(products: 'ProductCatalog', all_spheres: List[str]) -> None:
+    """Start background decay process"""
+    SPHERE_DECAY_CONFIG["products_ref"] = products
     
-    thread = threading.Thread(target=background_decay_loop, daemon=True)
-    thread.start()
-    SPHERE_DECAY_CONFIG["background_thread"] = thread
+    scheduler = DecayScheduler(products, all_spheres)
+    SPHERE_DECAY_CONFIG["scheduler"] = scheduler
+    SPHERE_DECAY_CONFIG["background_thread"] = scheduler.start()
 
 
 def normalize_criteria_group(user: 'User', criteria_list: List[str]):
@@ -349,71 +577,807 @@ def normalize_criteria_group(user: 'User', criteria_list: List[str]):
                 user.criteria_scores[criterion] = max(0.2, user.criteria_scores[criterion])
 
 
+@contextmanager
+def locked_file(f):
+    """Hold an exclusive advisory lock on an open file (no-op where fcntl is unavailable)"""
+    if fcntl is None:
+        yield f
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield f
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def file_lock(path: str):
+    """Exclusive advisory lock on the lock file at path, shared with other processes"""
+    with open(path, 'a') as f, locked_file(f):
+        yield
+
+
+def _fsync_directory(directory: str):
+    """Make a rename in directory durable; not supported on Windows"""
+    if os.name == 'nt':
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path: str, data, lock_path: str = None):
+    """
+    Replace path with data (str or bytes) so readers and crashes only ever see
+    the old or the new contents: write a temp file, fsync it, rename it over
+    path and fsync the directory. lock_path serializes writers across processes.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    binary = isinstance(data, bytes)
+    with file_lock(lock_path) if lock_path else nullcontext():
+        try:
+            with open(tmp_path, 'wb' if binary else 'w', encoding=None if binary else 'utf-8') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    _fsync_directory(os.path.dirname(os.path.abspath(path)))
+
+
+class WriteCoalescer:
+    """
+    Collapses bursts of saves into one write per target. submit(key, write)
+    replaces any pending write for key; pending writes run on a timer thread
+    delay seconds after the first save of a burst, or at once on flush().
+    A crash loses at most the last delay seconds of saves, and never more
+    than max_pending targets: reaching that many flushes at once.
+    delay=0 writes immediately.
+    """
+    
+    def __init__(self, delay: float = 0.5, max_pending: int = 256):
+        self.delay = delay
+        self.max_pending = max_pending
+        self._pending: Dict[str, object] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+    
+    def submit(self, key: str, write):
+        """Schedule write() as the next contents of key"""
+        if self.delay <= 0:
+            with self._flush_lock:
+                write()
+            return
+        with self._lock:
+            self._pending[key] = write
+            full = len(self._pending) >= self.max_pending
+            if self._timer is None and not full:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+    
+    def pending(self, key: str) -> bool:
+        return key in self._pending
+    
+    def flush(self, key: str = None):
+        """Run the pending write for key, or all pending writes; returns once they are on disk"""
+        with self._flush_lock:
+            with self._lock:
+                if key is None:
+                    writes = list(self._pending.items())
+                    self._pending.clear()
+                    if self._timer is not None:
+                        self._timer.cancel()
+                        self._timer = None
+                elif key in self._pending:
+                    writes = [(key, self._pending.pop(key))]
+                else:
+                    writes = []
+            
+            for i, (pending_key, write) in enumerate(writes):
+                try:
+                    write()
+                except BaseException:
+                    with self._lock:
+                        for failed_key, failed in writes[i:]:
+                            self._pending.setdefault(failed_key, failed)
+                    raise
+    
+    def close(self):
+        self.flush()
+
+
+class TransactionLog:
+    """
+    Append-only JSON Lines transaction store.
+    Every append reaches the OS immediately; fsync is batched to every
+    fsync_every records or fsync_interval seconds, whichever comes first.
+    """
+    
+    def __init__(self, path: str, fsync_every: int = 32, fsync_interval: float = 1.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def migrate_from(self, legacy_path: str):
+        """One-time import of a legacy {"transactions": [...]} file; the legacy file is left in place"""
+        if os.path.exists(self.path) or not os.path.exists(legacy_path):
+            return
+        
+        with open(legacy_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        transactions = data.get("transactions", []) if isinstance(data, dict) else []
+        
+        atomic_write(self.path, "".join(json.dumps(t, ensure_ascii=False) + "\n" for t in transactions))
+    
+    def append(self, transaction: Dict):
+        """Append one transaction; O(1) regardless of history size"""
+        line = json.dumps(transaction, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = self._open()
+            with locked_file(self._file):  # one whole line per writer, also across processes
+                self._file.write(line)
+                self._file.flush()
+            self._unsynced += 1
+            
+            if (self._unsynced >= self.fsync_every or
+                    time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._sync()
+    
+    def _open(self):
+        """Open for appending, terminating a torn last line so it can't swallow the next record"""
+        f = open(self.path, 'a+b')
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+        f.close()
+        return open(self.path, 'a', encoding='utf-8')
+    
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+    
+    def flush(self):
+        """Force pending appends to disk"""
+        with self._lock:
+            if self._file is not None and self._unsynced:
+                self._sync()
+    
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                if self._unsynced:
+                    self._sync()
+                self._file.close()
+                self._file = None
+    
+    def iter_transactions(self):
+        """Stream transactions in append order, skipping a torn trailing line"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+class ProductJournal:
+    """
+    Write-behind store for catalog changes. Changed products are tracked as
+    dirty (id -> product record, or None once removed) and appended as one
+    batch of JSON Lines per flush, so a purchase costs a short line instead
+    of a catalog rewrite. Loading replays the journal over the catalog file;
+    it is folded back into that file once it holds compact_after records.
+    """
+    
+    def __init__(self, path: str, compact_after: int = 1000):
+        self.path = path
+        self.compact_after = compact_after
+        self._dirty: Dict[int, Dict] = {}
+        self._records = None
+        self._lock = threading.Lock()
+    
+    def mark(self, product_id: int, product):
+        """Record the new state of a product; None means it was removed"""
+        record = Product.from_dict(product).to_dict() if product is not None else None
+        with self._lock:
+            self._dirty[product_id] = record
+    
+    def dirty_count(self) -> int:
+        return len(self._dirty)
+    
+    def discard(self):
+        """Forget dirty changes, e.g. because a full catalog save covers them"""
+        with self._lock:
+            self._dirty = {}
+    
+    def write_dirty(self) -> int:
+        """Append all dirty changes with one write and fsync; returns how many"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        
+        records = self.record_count()
+        data = "".join(json.dumps({"id": product_id, "product": record}, ensure_ascii=False) + "\n"
+                       for product_id, record in dirty.items()).encode('utf-8')
+        with open(self.path, 'a+b') as f, locked_file(f):
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    data = b"\n" + data  # terminate a torn last line so it can't swallow this batch
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._records = records + len(dirty)
+        return len(dirty)
+    
+    def changes(self):
+        """Stream (product_id, record or None) in write order, skipping torn lines"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    change = json.loads(line)
+                    yield change["id"], change["product"]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    continue
+    
+    def record_count(self) -> int:
+        if self._records is None:
+            self._records = sum(1 for _ in self.changes())
+        return self._records
+    
+    def needs_compaction(self) -> bool:
+        return self.record_count() >= self.compact_after
+    
+    def reset(self):
+        """Empty the journal once its changes are in the catalog file"""
+        if os.path.exists(self.path):
+            atomic_write(self.path, "")
+        self._records = 0
+    
+    @staticmethod
+    def replay(products: List[Dict], changes) -> List['Product']:
+        """Apply journal changes to a product list, keeping catalog order"""
+        by_id = {p["id"]: p for p in products}
+        for product_id, record in changes:
+            if record is None:
+                by_id.pop(product_id, None)
+            else:
+                by_id[product_id] = Product.from_dict(record)
+        return list(by_id.values())
+
+
+class UserStore:
+    """
+    One JSON file per user, sharded into subdirectories by username hash,
+    so reading or updating a profile never touches other accounts.
+    Records are replaced atomically; with a WriteCoalescer, repeated saves
+    of one user within its delay are written once, and reads see them.
+    """
+    
+    def __init__(self, directory: str, writer: WriteCoalescer = None, lock_path: str = None):
+        self.directory = directory
+        self.writer = writer if writer is not None else WriteCoalescer(delay=0)
+        self.lock_path = lock_path
+    
+    def _path(self, username: str) -> str:
+        digest = hashlib.sha1(username.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + ".json")
+    
+    def migrate_from(self, legacy_path: str):
+        """One-time split of a legacy users.json; the legacy file is left in place"""
+        if os.path.isdir(self.directory):
+            return
+        
+        users = {}
+        if os.path.exists(legacy_path):
+            try:
+                with open(legacy_path, 'r', encoding='utf-8') as f:
+                    users = json.load(f)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{legacy_path} is corrupt ({e}); fix or remove it "
+                                 f"rather than starting with no accounts") from None
+        
+        os.makedirs(self.directory)
+        if isinstance(users, dict):
+            for record in users.values():
+                self.save(record)
+            self.writer.flush()
+    
+    def exists(self, username: str) -> bool:
+        path = self._path(username)
+        return self.writer.pending(path) or os.path.exists(path)
+    
+    def load(self, username: str):
+        """User record dict, or None if there is no such user"""
+        path = self._path(username)
+        self.writer.flush(path)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+    
+    def save(self, record: Dict):
+        """Write one user record, keyed by its username"""
+        path = self._path(record["username"])
+        data = json.dumps(record, indent=2, ensure_ascii=False)
+        
+        def write():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write(path, data, self.lock_path)
+        self.writer.submit(path, write)
+    
+    def __iter__(self):
+        """Stream every user record"""
+        self.writer.flush()
+        for root, _, files in os.walk(self.directory):
+            for name in sorted(files):
+                if name.endswith(".json"):
+                    with open(os.path.join(root, name), 'r', encoding='utf-8') as f:
+                        yield json.load(f)
+
+
 class Database:
-    """Simple JSON-based database for users and products"""
+    """
+    Simple JSON-based database for users and products.
+    SQLiteDatabase implements the same interface and can be passed to
+    TerminalInterface instead.
+    Every file is replaced atomically under an advisory lock. Persistence
+    is write-behind: user saves and catalog changes are held as dirty for
+    up to write_delay seconds or max_pending entries, then written in one
+    batch; close() or flush() writes them out at once. Listing, withdrawing
+    and buying a product only append to a product journal, which is folded
+    into products.json every compact_after changes.
+    """
     
-    def __init__(self):
-        self.users_file = "users.json"
+    DATA_PATHS = ("users", "users.json", "products.json", "products.journal.jsonl",
+                  "transactions.jsonl", "transactions.json")
+    
+    @staticmethod
+    def has_data() -> bool:
+        """Whether JSON marketplace data exists in the working directory"""
+        return any(os.path.exists(path) for path in Database.DATA_PATHS)
+    
+    def __init__(self, write_delay: float = 0.5, max_pending: int = 256, compact_after: int = 1000):
+        self.users_dir = "users"
+        self.legacy_users_file = "users.json"
         self.products_file = "products.json"
-        self.transactions_file = "transactions.json"
+        self.products_snapshot_file = "products.json.snapshot"
+        self.products_journal_file = "products.journal.jsonl"
+        self.transactions_file = "transactions.jsonl"
+        self.legacy_transactions_file = "transactions.json"
+        self.lock_file = "marketplace.lock"
+        self.writer = WriteCoalescer(write_delay, max_pending)
+        self.product_journal = ProductJournal(self.products_journal_file, compact_after)
+        self._pending_catalog = None
+        self._products_lock = threading.Lock()
+        self.legacy_decay_scores: Dict[int, float] = {}  # found in products.json, for load_catalog to adopt
+        self.transaction_log = TransactionLog(self.transactions_file)
+        self.user_store = UserStore(self.users_dir, self.writer, self.lock_file)
         self._init_files()
     
     def _init_files(self):
         """Initialize database files if they don't exist"""
-        for file in [self.users_file, self.products_file, self.transactions_file]:
-            if not os.path.exists(file):
-                with open(file, 'w') as f:
-                    json.dump({}, f)
+        if not os.path.exists(self.products_file):
+            atomic_write(self.products_file, json.dumps({}), self.lock_file)
+        
+        self.user_store.migrate_from(self.legacy_users_file)
+        
+        self.transaction_log.migrate_from(self.legacy_transactions_file)
+        if not os.path.exists(self.transactions_file):
+            open(self.transactions_file, 'a').close()
     
-    def load_users(self):
-        """FIXED: Added type checking for loaded data"""
-        try:
-            with open(self.users_file, "r") as f:
-                data = f.read().strip()
-                if not data:
-                    return {}  
-                result = json.loads(data)
-                if not isinstance(result, dict):
-                    return {}
-                return result
-        except FileNotFoundError:
-            return {}          
-        except json.JSONDecodeError:
-            return {}
+    def flush(self):
+        """Write out coalesced saves and pending transactions now"""
+        self.writer.flush()
+        self.transaction_log.flush()
+    
+    def close(self):
+        """Flush buffered writes"""
+        self.writer.close()
+        self.transaction_log.close()
+    
+    def load_users(self) -> Dict[str, Dict]:
+        """Load all users, keyed by username (reads every record)"""
+        return {record["username"]: record for record in self.user_store}
     
     def save_users(self, users: Dict):
-        """Save all users to database"""
-        with open(self.users_file, "w") as f:
-            json.dump(users, f, indent=2, ensure_ascii=False)
+        """Save several users"""
+        for record in users.values():
+            self.user_store.save(record)
+    
+    def load_user(self, username: str):
+        """Load one user record, or None if it doesn't exist"""
+        return self.user_store.load(username)
+    
+    def save_user(self, record: Dict):
+        """Save one user record"""
+        self.user_store.save(record)
+    
+    def user_exists(self, username: str) -> bool:
+        return self.user_store.exists(username)
     
     def load_products(self) -> List[Dict]:
-        """Load all products from database"""
-        with open(self.products_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        """Load all products: the catalog file (via its snapshot) with the journal replayed over it"""
+        self.writer.flush(self.products_file)
+        products = self._load_catalog_file()
+        changes = list(self.product_journal.changes())
+        if changes:
+            products = ProductJournal.replay(products, changes)
+        return products
+    
+    def _load_catalog_file(self) -> List['Product']:
+        """Products in products.json, from the binary snapshot while it still matches"""
+        with file_lock(self.lock_file):
+            with open(self.products_file, 'rb') as f:
+                raw = f.read()
+            products = self._load_snapshot(raw)
+            if products is not None:
+                return products
+            
+            data = json.loads(raw.decode('utf-8'))
             if isinstance(data, dict):
-                return data.get("products", [])
+                products = data.get("products", [])
             elif isinstance(data, list):
-                return data
+                products = data
             else:
-                return []
+                products = []
+            
+            self.legacy_decay_scores.update(
+                (p["id"], p["decay_score"]) for p in products if "decay_score" in p
+            )
+            products = [Product.from_dict(p) for p in products]
+            self._save_snapshot(products, raw)
+        return products
     
     def save_products(self, products: List[Dict]):
-        """Save all products to database"""
-        with open(self.products_file, 'w', encoding='utf-8') as f:
-            json.dump({"products": products}, f, indent=2, ensure_ascii=False)
+        """Save all products to database, superseding any unwritten journal changes"""
+        products = [Product.from_dict(p) for p in products]
+        with self._products_lock:
+            self._pending_catalog = products
+            self.product_journal.discard()
+        self.writer.submit(self.products_file, self._flush_products)
+    
+    def _mark_product(self, product_id: int, product):
+        """Track one changed product (None if removed) for the next journal flush"""
+        self.product_journal.mark(product_id, product)
+        self.writer.submit(self.products_file, self._flush_products)
+        if self.product_journal.dirty_count() >= self.writer.max_pending:
+            self.writer.flush(self.products_file)
+    
+    def _flush_products(self):
+        """Write a pending full catalog, then append dirty changes made since"""
+        with self._products_lock:
+            products, self._pending_catalog = self._pending_catalog, None
+        if products is not None:
+            self._write_catalog_file(products)
+        
+        self.product_journal.write_dirty()
+        if self.product_journal.needs_compaction():
+            self._write_catalog_file(ProductJournal.replay(self._load_catalog_file(),
+                                                           self.product_journal.changes()))
+    
+    def _write_catalog_file(self, products: List['Product']):
+        """Replace products.json and its snapshot with products, emptying the journal they include"""
+        data = json.dumps({"products": [dict(p) for p in products]}, indent=2,
+                          ensure_ascii=False).encode('utf-8')
+        # one lock for both files, so the snapshot never describes another writer's JSON
+        with file_lock(self.lock_file):
+            atomic_write(self.products_file, data)
+            self._save_snapshot(products, data)
+        self.product_journal.reset()
+    
+    @staticmethod
+    def _snapshot_key(raw: bytes) -> Tuple:
+        """Identity of products.json contents: format version, size and digest of the bytes"""
+        return SNAPSHOT_VERSION, len(raw), hashlib.blake2b(raw, digest_size=16).digest()
+    
+    def _load_snapshot(self, raw: bytes):
+        """
+        Products from the snapshot if it was made from exactly raw, else
+        None. The snapshot is only a cache: any failure to read it (missing,
+        corrupt, written by an incompatible version) returns None, so the
+        catalog is rebuilt from products.json and the snapshot rewritten.
+        """
+        try:
+            with open(self.products_snapshot_file, 'rb') as f:
+                snapshot = pickle.load(f)
+            if snapshot["source"] == self._snapshot_key(raw) and isinstance(snapshot["products"], list):
+                return snapshot["products"]
+        except Exception:
+            pass
+        return None
+    
+    def _save_snapshot(self, products: List['Product'], raw: bytes):
+        """Write the snapshot of products, keyed to raw, the products.json bytes they came from"""
+        try:
+            atomic_write(self.products_snapshot_file,
+                         pickle.dumps({"source": self._snapshot_key(raw), "products": products},
+                                      protocol=pickle.HIGHEST_PROTOCOL))
+        except OSError:
+            pass
+    
+    def add_product(self, product: Dict, products: List[Dict] = None):
+        """Persist a newly listed product"""
+        self._mark_product(product["id"], product)
+    
+    def remove_product(self, product_id: int, products: List[Dict] = None):
+        """Persist a withdrawn product"""
+        self._mark_product(product_id, None)
+    
+    def products_by_sphere(self, sphere: str) -> List[Dict]:
+        return [p for p in self.load_products() if p["sphere"] == sphere]
+    
+    def products_by_owner(self, owner: str) -> List[Dict]:
+        return [p for p in self.load_products() if p["owner"] == owner]
+    
+    def purchase(self, buyer: Dict, seller, product_id: int, transaction: Dict, products: List[Dict]):
+        """
+        Persist a purchase: buyer and seller records, the transaction and the
+        product's removal. Each is written atomically, but one after another
+        and (except the transaction) write-behind, so unlike SQLiteDatabase
+        the purchase as a whole is not atomic.
+        """
+        if seller is not None:
+            self.save_user(seller)
+        self.save_user(buyer)
+        self.save_transaction(transaction)
+        self._mark_product(product_id, None)
     
     def load_transactions(self) -> List[Dict]:
         """Load all transactions"""
-        with open(self.transactions_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data.get("transactions", [])
+        return list(self.iter_transactions())
+    
+    def iter_transactions(self):
+        """Stream transactions without loading the whole history"""
+        return self.transaction_log.iter_transactions()
+    
+    def save_transaction(self, transaction: Dict):
+        """Append a new transaction to the log"""
+        self.transaction_log.append(transaction)
+
+
+class SQLiteDatabase:
+    """
+    SQLite storage backend with the same interface as Database.
+    Products are indexed by sphere, type, owner and price, users are stored
+    as their to_dict records, and a purchase commits in one transaction.
+    """
+    
+    PRODUCT_COLUMNS = ("id", "name", "sphere", "type", "price", "owner",
+                       "quality", "price_level", "delivery", "tags")
+    
+    def __init__(self, path: str = "marketplace.db"):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._init_schema()
+    
+    def _init_schema(self):
+        with self._lock, self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS products (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    sphere TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    price REAL NOT NULL,
+                    owner TEXT NOT NULL,
+                    quality TEXT,
+                    price_level TEXT,
+                    delivery TEXT,
+                    tags TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_products_sphere ON products (sphere);
+                CREATE INDEX IF NOT EXISTS idx_products_type ON products (type);
+                CREATE INDEX IF NOT EXISTS idx_products_owner ON products (owner);
+                CREATE INDEX IF NOT EXISTS idx_products_price ON products (price);
+                
+                CREATE TABLE IF NOT EXISTS users (
+                    username TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                
+                CREATE TABLE IF NOT EXISTS transactions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    buyer TEXT,
+                    seller TEXT,
+                    date TEXT,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_transactions_buyer ON transactions (buyer);
+            """)
+    
+    def migrate_from(self, database: 'Database'):
+        """Copy products, users and transactions from a JSON Database into empty tables"""
+        with self._lock:
+            has_products = self._conn.execute("SELECT 1 FROM products LIMIT 1").fetchone()
+            has_users = self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone()
+        if not has_products:
+            self.save_products(database.load_products())
+        if not has_users:
+            self.save_users(database.load_users())
+            for transaction in database.iter_transactions():
+                self.save_transaction(transaction)
+    
+    def is_empty(self) -> bool:
+        """No products and no users yet"""
+        with self._lock:
+            return not (self._conn.execute("SELECT 1 FROM products LIMIT 1").fetchone() or
+                        self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone())
+    
+    def migrate_if_empty(self) -> bool:
+        """
+        On first use, copy in the JSON data of the working directory (if
+        any), so switching backends keeps users, listings and purchase
+        history. Returns whether anything was migrated.
+        """
+        if not self.is_empty() or not Database.has_data():
+            return False
+        source = Database()
+        try:
+            self.migrate_from(source)
+        finally:
+            source.close()
+        return True
+    
+    def flush(self):
+        """Nothing is buffered: every write is committed as it is made"""
+    
+    def close(self):
+        with self._lock:
+            self._conn.close()
+    
+    @staticmethod
+    def _product_row(product: Dict) -> Tuple:
+        return tuple(
+            json.dumps(list(product.get("tags") or []), ensure_ascii=False) if column == "tags"
+            else product.get(column)
+            for column in SQLiteDatabase.PRODUCT_COLUMNS
+        )
+    
+    @staticmethod
+    def _product_from_row(row: Tuple) -> Dict:
+        product = dict(zip(SQLiteDatabase.PRODUCT_COLUMNS, row))
+        product["tags"] = json.loads(product["tags"])
+        return product
+    
+    def _query_products(self, where: str = "", params: Tuple = ()) -> List[Dict]:
+        sql = f"SELECT {', '.join(self.PRODUCT_COLUMNS)} FROM products {where} ORDER BY id"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [self._product_from_row(row) for row in rows]
+    
+    def load_products(self) -> List[Dict]:
+        return self._query_products()
+    
+    def save_products(self, products: List[Dict]):
+        """Replace the whole catalog"""
+        placeholders = ", ".join("?" for _ in self.PRODUCT_COLUMNS)
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM products")
+            self._conn.executemany(
+                f"INSERT INTO products ({', '.join(self.PRODUCT_COLUMNS)}) VALUES ({placeholders})",
+                (self._product_row(p) for p in products)
+            )
+    
+    def add_product(self, product: Dict, products: List[Dict] = None):
+        placeholders = ", ".join("?" for _ in self.PRODUCT_COLUMNS)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT INTO products ({', '.join(self.PRODUCT_COLUMNS)}) VALUES ({placeholders})",
+                self._product_row(product)
+            )
+    
+    def remove_product(self, product_id: int, products: List[Dict] = None):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM products WHERE id = ?", (product_id,))
+    
+    def products_by_sphere(self, sphere: str) -> List[Dict]:
+        return self._query_products("WHERE sphere = ?", (sphere,))
+    
+    def products_by_owner(self, owner: str) -> List[Dict]:
+        return self._query_products("WHERE owner = ?", (owner,))
+    
+    def products_by_type(self, product_type: str) -> List[Dict]:
+        return self._query_products("WHERE type = ?", (product_type,))
+    
+    def products_in_price_range(self, min_price: float, max_price: float) -> List[Dict]:
+        return self._query_products("WHERE price BETWEEN ? AND ?", (min_price, max_price))
+    
+    def load_users(self) -> Dict[str, Dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM users").fetchall()
+        records = (json.loads(data) for (data,) in rows)
+        return {record["username"]: record for record in records}
+    
+    def save_users(self, users: Dict):
+        with self._lock, self._conn:
+            for record in users.values():
+                self._save_user(record)
+    
+    def load_user(self, username: str):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def save_user(self, record: Dict):
+        with self._lock, self._conn:
+            self._save_user(record)
+    
+    def _save_user(self, record: Dict):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)",
+            (record["username"], json.dumps(record, ensure_ascii=False))
+        )
+    
+    def user_exists(self, username: str) -> bool:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM users WHERE username = ?", (username,)
+            ).fetchone() is not None
+    
+    def load_transactions(self) -> List[Dict]:
+        return list(self.iter_transactions())
+    
+    def iter_transactions(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM transactions ORDER BY id").fetchall()
+        for (data,) in rows:
+            yield json.loads(data)
     
     def save_transaction(self, transaction: Dict):
-        """Save a new transaction"""
-        transactions = self.load_transactions()
-        transactions.append(transaction)
-        with open(self.transactions_file, 'w', encoding='utf-8') as f:
-            json.dump({"transactions": transactions}, f, indent=2, ensure_ascii=False)
+        with self._lock, self._conn:
+            self._save_transaction(transaction)
+    
+    def _save_transaction(self, transaction: Dict):
+        self._conn.execute(
+            "INSERT INTO transactions (buyer, seller, date, data) VALUES (?, ?, ?, ?)",
+            (transaction.get("buyer"), transaction.get("seller"), transaction.get("date"),
+             json.dumps(transaction, ensure_ascii=False))
+        )
+    
+    def purchase(self, buyer: Dict, seller, product_id: int, transaction: Dict, products: List[Dict] = None):
+        """
+        Debit buyer, credit seller, remove the product and record the
+        transaction in one commit. Raises ValueError, writing nothing,
+        if the product has already been sold or withdrawn.
+        """
+        with self._lock, self._conn:
+            removed = self._conn.execute("DELETE FROM products WHERE id = ?", (product_id,)).rowcount
+            if not removed:
+                raise ValueError(f"Product {product_id} is no longer available")
+            if seller is not None:
+                self._save_user(seller)
+            self._save_user(buyer)
+            self._save_transaction(transaction)
 
 
 UNIVERSAL_TAGS = {
@@ -486,100 +1450,359 @@ PRODUCT_TAGS = {
 }
 
 
-def load_products_from_excel(filepath: str) -> List[Dict]:
-    """Load products from Excel file and convert to product objects"""
-    wb = openpyxl.load_workbook(filepath)
-    products = []
-    product_id = 1
-    
-    for sheet_name in wb.sheetnames:
-        sphere = SPHERE_MAPPING.get(sheet_name, sheet_name)
-        sheet = wb[sheet_name]
-        
-        current_row = 1
-        while current_row <= sheet.max_row:
-            cell_value = sheet.cell(current_row, 1).value
-            if cell_value and isinstance(cell_value, str) and cell_value.strip():
-                product_type = cell_value.strip()
-                
-                if current_row + 1 <= sheet.max_row:
-                    criteria_row = current_row + 1
-                    
-                    data_row = current_row + 2
-                    while data_row <= sheet.max_row:
-                        next_cell = sheet.cell(data_row, 1).value
-                        if next_cell and isinstance(next_cell, str) and not any(
-                            sheet.cell(data_row, col).value for col in range(2, 10)
-                        ):
-                            break
-                        
-                        product_name = sheet.cell(data_row, 1).value
-                        if product_name and isinstance(product_name, str):
-                            product = {
-                                "id": product_id,
-                                "name": product_name.strip(),
-                                "sphere": sphere,
-                                "type": product_type,
-                                "price": round(random.uniform(10, 500), 2),
-                                "owner": "system",
-                                "quality": None,
-                                "price_level": None,
-                                "delivery": None,
-                                "tags": []
-                            }
-                            
-                            for col in range(1, 4):
-                                if sheet.cell(data_row, col).value:
-                                    if col == 1:
-                                        product["quality"] = "premium"
-                                    elif col == 2:
-                                        product["quality"] = "medium"
-                                    elif col == 3:
-                                        product["quality"] = "budget"
-                                    break
-                            
-                            for col in range(4, 7):
-                                if sheet.cell(data_row, col).value:
-                                    if col == 4:
-                                        product["price_level"] = "cheap"
-                                    elif col == 5:
-                                        product["price_level"] = "average"
-                                    elif col == 6:
-                                        product["price_level"] = "expensive"
-                                    break
-                            
-                            for col in range(7, 10):
-                                if sheet.cell(data_row, col).value:
-                                    if col == 7:
-                                        product["delivery"] = "1day"
-                                    elif col == 8:
-                                        product["delivery"] = "2-3days"
-                                    elif col == 9:
-                                        product["delivery"] = "4+days"
-                                    break
-                            
-                            tags_cell = sheet.cell(data_row, 10).value
-                            if tags_cell and isinstance(tags_cell, str):
-                                product["tags"] = [t.strip() for t in tags_cell.split(',') if t.strip()]
-                            else:
-                                if product_type in PRODUCT_TAGS:
-                                    product["tags"] = PRODUCT_TAGS[product_type]
-                                else:
-                                    product["tags"] = ["general", "product"]
-                            
-                            if all([product["quality"], product["price_level"], product["delivery"]]):
-                                products.append(product)
-                                product_id += 1
-                        
-                        data_row += 1
-                    
-                    current_row = data_row
-                else:
-                    current_row += 1
+QUALITY_COLUMNS = ("premium", "medium", "budget")
+PRICE_LEVEL_COLUMNS = ("cheap", "average", "expensive")
+DELIVERY_COLUMNS = ("1day", "2-3days", "4+days")
+
+
+def _first_marked(row: Tuple, start: int, values: Tuple[str, ...]):
+    """Value for the first non-empty cell among row[start:start + 3]"""
+    for offset, value in enumerate(values):
+        if row[start + offset]:
+            return value
+    return None
+
+
+def parse_sheet_rows(rows, sphere: str):
+    """
+    Yield product candidates from a sheet's row tuples.
+    A text cell in column A with nothing in B-I starts a product type; the
+    row after it holds the criteria labels and is skipped; the following
+    rows are products until the next type header. Candidates have no id
+    or price yet and may lack quality, price_level or delivery.
+    """
+    state = "seek"
+    product_type = None
+    
+    for row in rows:
+        if len(row) < 10:
+            row = tuple(row) + (None,) * (10 - len(row))
+        first = row[0]
+        
+        if state == "data":
+            if first and isinstance(first, str) and not any(row[1:9]):
+                state = "seek"
             else:
-                current_row += 1
+                if first and isinstance(first, str):
+                    tags_cell = row[9]
+                    if tags_cell and isinstance(tags_cell, str):
+                        tags = [t.strip() for t in tags_cell.split(',') if t.strip()]
+                    elif product_type in PRODUCT_TAGS:
+                        tags = PRODUCT_TAGS[product_type]
+                    else:
+                        tags = ["general", "product"]
+                    
+                    yield {
+                        "name": first.strip(),
+                        "sphere": sphere,
+                        "type": product_type,
+                        "quality": _first_marked(row, 0, QUALITY_COLUMNS),
+                        "price_level": _first_marked(row, 3, PRICE_LEVEL_COLUMNS),
+                        "delivery": _first_marked(row, 6, DELIVERY_COLUMNS),
+                        "tags": tags
+                    }
+                continue
+        
+        if state == "criteria":
+            state = "data"
+        elif first and isinstance(first, str) and first.strip():
+            product_type = first.strip()
+            state = "criteria"
+
+
+def finalize_candidates(candidates, start_id: int = 1):
+    """
+    Price candidates and number the complete ones from start_id.
+    A price is drawn for every candidate, complete or not, so the random
+    sequence matches the original cell-by-cell importer.
+    """
+    product_id = start_id
+    for candidate in candidates:
+        product = {
+            "id": product_id,
+            "name": candidate["name"],
+            "sphere": candidate["sphere"],
+            "type": candidate["type"],
+            "price": round(random.uniform(10, 500), 2),
+            "owner": "system",
+            "quality": candidate["quality"],
+            "price_level": candidate["price_level"],
+            "delivery": candidate["delivery"],
+            "tags": candidate["tags"]
+        }
+        if all([product["quality"], product["price_level"], product["delivery"]]):
+            yield product
+            product_id += 1
+
+
+def iter_excel_candidates(filepath: str):
+    """Stream product candidates from every sheet using a read-only workbook"""
+    wb = openpyxl.load_workbook(filepath, read_only=True)
+    try:
+        for sheet_name in wb.sheetnames:
+            sphere = SPHERE_MAPPING.get(sheet_name, sheet_name)
+            yield from parse_sheet_rows(wb[sheet_name].iter_rows(values_only=True), sphere)
+    finally:
+        wb.close()
+
+
+def iter_products_from_excel(filepath: str, start_id: int = 1):
+    """Stream products from an Excel file without loading the workbook into memory"""
+    return finalize_candidates(iter_excel_candidates(filepath), start_id)
+
+
+def read_sheet(filepath: str, sheet_name: str, with_content: bool = False):
+    """
+    Parse one sheet into product candidates in its own read-only workbook,
+    so sheets can be processed by separate worker processes.
+    Returns (content_hash, candidates); content_hash is None unless requested.
+    """
+    wb = openpyxl.load_workbook(filepath, read_only=True)
+    try:
+        sphere = SPHERE_MAPPING.get(sheet_name, sheet_name)
+        rows = wb[sheet_name].iter_rows(values_only=True)
+        content = None
+        if with_content:
+            rows = list(rows)
+            content = hashlib.sha1(repr(rows).encode('utf-8')).hexdigest()
+        return content, list(parse_sheet_rows(rows, sphere))
+    finally:
+        wb.close()
+
+
+def _sheet_workers(workers: int, sheet_count: int) -> int:
+    """
+    Number of processes to parse sheet_count sheets with: at most one per
+    sheet and per CPU, so a single sheet or a single CPU is parsed serially
+    instead of paying for a process pool.
+    """
+    cpus = os.cpu_count() or 1
+    return max(1, min(workers or cpus, cpus, sheet_count))
+
+
+def read_sheets(filepath: str, sheet_names: List[str], workers: int = None, with_content: bool = False):
+    """
+    read_sheet over several sheets, yielding results in sheet order.
+    Uses a process pool of up to workers processes (default: CPU count);
+    one worker, one sheet or one CPU is read in-process.
+    """
+    workers = _sheet_workers(workers, len(sheet_names))
+    if workers <= 1:
+        for sheet_name in sheet_names:
+            yield read_sheet(filepath, sheet_name, with_content)
+        return
     
-    return products
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(read_sheet, repeat(filepath), sheet_names, repeat(with_content))
+
+
+def load_products_from_excel(filepath: str, workers: int = None) -> List[Dict]:
+    """
+    Load products from Excel file and convert to product objects.
+    Sheets are parsed in parallel across up to workers processes (default:
+    CPU count); ids and prices are assigned afterwards in sheet order, so
+    the result is the same as the serial importer's. workers=1 streams
+    the workbook in-process.
+    """
+    wb = openpyxl.load_workbook(filepath, read_only=True)
+    sheet_names = wb.sheetnames
+    wb.close()
+    
+    workers = _sheet_workers(workers, len(sheet_names))
+    if workers <= 1:
+        return list(iter_products_from_excel(filepath))
+    
+    candidates = chain.from_iterable(
+        sheet_candidates for _, sheet_candidates in read_sheets(filepath, sheet_names, workers)
+    )
+    return list(finalize_candidates(candidates))
+
+
+def sheet_fingerprints(filepath: str) -> Dict[str, str]:
+    """
+    Cheap per-sheet fingerprints read from the xlsx zip directory: CRC and
+    size of each worksheet part plus the shared strings table, so no sheet
+    has to be decompressed. Returns {} if the workbook layout is unexpected.
+    """
+    main_ns = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+    rel_id = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+    try:
+        with zipfile.ZipFile(filepath) as zf:
+            workbook = ElementTree.fromstring(zf.read("xl/workbook.xml"))
+            rels = ElementTree.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+            targets = {rel.get("Id"): rel.get("Target", "") for rel in rels}
+            names = set(zf.namelist())
+            shared_crc = zf.getinfo("xl/sharedStrings.xml").CRC if "xl/sharedStrings.xml" in names else 0
+            
+            fingerprints = {}
+            for sheet in workbook.iter(main_ns + "sheet"):
+                target = targets.get(sheet.get(rel_id), "")
+                part = target.lstrip("/") if target.startswith("/") else "xl/" + target
+                if part in names:
+                    info = zf.getinfo(part)
+                    fingerprints[sheet.get("name")] = f"{info.CRC:08x}:{info.file_size}:{shared_crc:08x}"
+            return fingerprints
+    except (KeyError, zipfile.BadZipFile, ElementTree.ParseError):
+        return {}
+
+
+def _sheet_entry_key(product_type: str, name: str, occurrence: int) -> str:
+    return f"{product_type}\x1f{name}\x1f{occurrence}"
+
+
+def _sheet_entries_from_catalog(catalog: 'ProductCatalog', sphere: str) -> Dict[str, List]:
+    """Reconstruct a sheet's import entries from system products already in the catalog"""
+    entries, occurrences = {}, {}
+    for p in catalog.by_sphere(sphere):
+        if p["owner"] != "system":
+            continue
+        base = (p["type"], p["name"])
+        occurrences[base] = occurrences.get(base, 0) + 1
+        entries[_sheet_entry_key(p["type"], p["name"], occurrences[base])] = [
+            p["id"], p["quality"], p["price_level"], p["delivery"], list(p["tags"])
+        ]
+    return entries
+
+
+def _merge_sheet(catalog: 'ProductCatalog', candidates, previous: Dict[str, List], report: Dict) -> Dict[str, List]:
+    """
+    Apply one sheet's candidates to the catalog against the entries of its
+    previous import, keeping ids of existing products. Returns the new entries.
+    """
+    previous = dict(previous)
+    entries, occurrences = {}, {}
+    
+    for c in candidates:
+        if not all([c["quality"], c["price_level"], c["delivery"]]):
+            continue
+        base = (c["type"], c["name"])
+        occurrences[base] = occurrences.get(base, 0) + 1
+        key = _sheet_entry_key(c["type"], c["name"], occurrences[base])
+        attributes = [c["quality"], c["price_level"], c["delivery"], list(c["tags"])]
+        
+        old = previous.pop(key, None)
+        if old is None:
+            product = catalog.add({
+                "id": catalog.next_id(),
+                "name": c["name"],
+                "sphere": c["sphere"],
+                "type": c["type"],
+                "price": round(random.uniform(10, 500), 2),
+                "owner": "system",
+                "quality": c["quality"],
+                "price_level": c["price_level"],
+                "delivery": c["delivery"],
+                "tags": c["tags"]
+            })
+            report["added"].append(product)
+            entries[key] = [product["id"]] + attributes
+            continue
+        
+        entries[key] = [old[0]] + attributes
+        current = catalog.get(old[0])
+        if old[1:] != attributes and current is not None:
+            updated = dict(current)
+            updated.update(quality=c["quality"], price_level=c["price_level"],
+                           delivery=c["delivery"], tags=c["tags"])
+            report["changed"].append(catalog.replace(updated))
+    
+    for old in previous.values():
+        removed = catalog.remove(old[0])
+        if removed is not None:
+            report["removed"].append(removed)
+    return entries
+
+
+def import_products_incremental(filepath: str, catalog: 'ProductCatalog', state_path: str,
+                                workers: int = None, save_catalog=None) -> Dict:
+    """
+    Merge an Excel workbook into catalog, reprocessing only sheets that changed
+    since the import recorded in state_path. Existing products keep their ids
+    and prices, seller listings and already-sold products are left alone.
+    Sheets that need reading are parsed across up to workers processes.
+    Returns a report of added, removed and changed products and which sheets
+    were reprocessed or skipped. If the catalog changed, save_catalog(catalog)
+    must make it durable before state_path records the sheets as imported.
+    """
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        state = {}
+    previous_sheets = state.get("sheets", {})
+    fingerprints = sheet_fingerprints(filepath)
+    
+    report = {"added": [], "removed": [], "changed": [], "reprocessed_sheets": [], "skipped_sheets": []}
+    sheets = {}
+    
+    wb = openpyxl.load_workbook(filepath, read_only=True)
+    sheet_names = wb.sheetnames
+    wb.close()
+    
+    to_read = []
+    for sheet_name in sheet_names:
+        previous = previous_sheets.get(sheet_name)
+        fingerprint = fingerprints.get(sheet_name)
+        if previous is not None and fingerprint and previous["fingerprint"] == fingerprint:
+            sheets[sheet_name] = previous
+        else:
+            to_read.append(sheet_name)
+    
+    results = read_sheets(filepath, to_read, workers, with_content=True)
+    for sheet_name, (content, candidates) in zip(to_read, results):
+        previous = previous_sheets.get(sheet_name)
+        fingerprint = fingerprints.get(sheet_name)
+        if previous is not None and previous["content"] == content:
+            sheets[sheet_name] = dict(previous, fingerprint=fingerprint)
+            continue
+        
+        sphere = SPHERE_MAPPING.get(sheet_name, sheet_name)
+        entries = previous["products"] if previous is not None else _sheet_entries_from_catalog(catalog, sphere)
+        sheets[sheet_name] = {
+            "fingerprint": fingerprint,
+            "content": content,
+            "products": _merge_sheet(catalog, candidates, entries, report)
+        }
+        report["reprocessed_sheets"].append(sheet_name)
+    
+    report["skipped_sheets"] = [s for s in sheet_names if s not in report["reprocessed_sheets"]]
+    sheets = {s: sheets[s] for s in sheet_names}
+    
+    for sheet_name, previous in previous_sheets.items():
+        if sheet_name not in sheets:
+            _merge_sheet(catalog, (), previous["products"], report)
+    
+    if save_catalog is not None and (report["added"] or report["removed"] or report["changed"]):
+        save_catalog(catalog)
+    atomic_write(state_path, json.dumps({"sheets": sheets}, ensure_ascii=False))
+    return report
+
+
+def load_catalog(db, import_state_path: str, excel_path: str = None,
+                 decay_state_path: str = None) -> Tuple['ProductCatalog', Dict]:
+    """
+    Load the catalog from db and apply the supplier workbook if it exists.
+    With decay_state_path, the catalog's decay state is loaded from it and
+    saved back to it through the database's write coalescer.
+    Returns the catalog and the import report (None if there was no workbook).
+    """
+    excel_path = excel_path or EXCEL_IMPORT_PATH
+    catalog = ProductCatalog(db.load_products())
+    if decay_state_path is not None:
+        catalog.decay.load(decay_state_path)
+        catalog.decay.persist_to(decay_state_path, getattr(db, "writer", None))
+    catalog.decay.adopt_legacy(getattr(db, "legacy_decay_scores", {}))
+    if not os.path.exists(excel_path):
+        return catalog, None
+    
+    def save_catalog(products):
+        # flushed, not write-behind: import_state.json must never get ahead of the catalog
+        db.save_products(products)
+        db.flush()
+    
+    report = import_products_incremental(excel_path, catalog, import_state_path,
+                                         save_catalog=save_catalog)
+    return catalog, report
 
 
 class User:
@@ -593,9 +1816,17 @@ class User:
         self.location = location
         self.balance = max(0, balance)
         
-        age_group = self._get_age_group()
-        self.sphere_scores = self._init_sphere_scores(age_group, gender)
-        self.criteria_scores = self._init_criteria_scores(location)
+        self.reset_preferences()
+        
+        self.recommended_purchases = set()
+        self.purchase_history = []
+        self.interest_answers = []
+        self.profile_version = next(PROFILE_VERSIONS)
+    
+    def reset_preferences(self):
+        """Back to the demographic profile, before any purchase or questionnaire answer"""
+        self.sphere_scores = self._init_sphere_scores(self._get_age_group(), self.gender)
+        self.criteria_scores = self._init_criteria_scores(self.location)
         
         self.tag_scores = {}
         self.type_scores = {}
@@ -603,8 +1834,6 @@ class User:
         self.initial_influence = 1.0
         
         self.last_purchase_date = {}
-        self.recommended_purchases = set()
-        self.purchase_history = []
     
     def _get_age_group(self) -> str:
         """Determine age group"""
@@ -666,7 +1895,8 @@ class User:
             "initial_influence": self.initial_influence,
             "last_purchase_date": self.last_purchase_date,
             "recommended_purchases": list(self.recommended_purchases),
-            "purchase_history": self.purchase_history
+            "purchase_history": self.purchase_history,
+            "interest_answers": self.interest_answers
         }
     
     @staticmethod
@@ -687,21 +1917,938 @@ class User:
         user.last_purchase_date = data.get("last_purchase_date", {})
         user.recommended_purchases = set(data.get("recommended_purchases", []))
         user.purchase_history = data.get("purchase_history", [])
+        user.interest_answers = data.get("interest_answers", [])
+        user.profile_version = next(PROFILE_VERSIONS)
         return user
+    
+    def bump_profile_version(self):
+        """Mark preferences as changed so cached recommendations are recomputed"""
+        self.profile_version = next(PROFILE_VERSIONS)
 
 
-class RecommendationEngine:
-    """Core recommendation algorithm"""
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Product(MutableMapping):
+    """
+    Compact product record behaving like the product dict.
+    Fields live in __slots__; repeated strings (sphere, type, owner,
+    quality, price_level, delivery, tags) are interned so every product
+    shares one copy, and tags are a tuple. Keys outside the product
+    schema go to a lazily created extra dict; scoring and decay keys
+    stored by older versions are dropped.
+    """
+    
+    FIELDS = ("id", "name", "sphere", "type", "price", "owner",
+              "quality", "price_level", "delivery", "tags")
+    LEGACY = frozenset(("_score", "decay_score"))
+    _INTERNED = ("sphere", "type", "owner", "quality", "price_level", "delivery")
+    _FIELD_SET = frozenset(FIELDS)
+    
+    __slots__ = FIELDS + ("extra",)
+    
+    def __init__(self, id: int, name: str, sphere: str, type: str, price: float, owner: str,
+                 quality: str, price_level: str, delivery: str, tags=()):
+        self.id = id
+        self.name = name
+        self.sphere = _intern(sphere)
+        self.type = _intern(type)
+        self.price = price
+        self.owner = _intern(owner)
+        self.quality = _intern(quality)
+        self.price_level = _intern(price_level)
+        self.delivery = _intern(delivery)
+        self.tags = tuple(map(sys.intern, tags)) if tags else ()
+        self.extra = None
+    
+    @staticmethod
+    def from_dict(data) -> 'Product':
+        """Build from a product dict; already-compact products are returned as is"""
+        if isinstance(data, Product):
+            return data
+        product = Product(*[data.get(field) for field in Product.FIELDS])
+        if len(data) > len(Product.FIELDS) or not Product._FIELD_SET.issuperset(data):
+            for key, value in data.items():
+                if key not in Product._FIELD_SET and key not in Product.LEGACY:
+                    product[key] = value
+        return product
+    
+    def to_dict(self) -> Dict:
+        product = dict(self)
+        product["tags"] = list(self.tags)
+        return product
+    
+    def __getitem__(self, key):
+        if key in Product._FIELD_SET:
+            return getattr(self, key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def __contains__(self, key) -> bool:
+        if key in Product._FIELD_SET:
+            return True
+        return self.extra is not None and key in self.extra
+    
+    def __setitem__(self, key, value):
+        if key in Product._FIELD_SET:
+            if key == "tags":
+                value = tuple(map(sys.intern, value)) if value else ()
+            elif key in Product._INTERNED:
+                value = _intern(value)
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+    
+    def __delitem__(self, key):
+        if key not in Product._FIELD_SET and self.extra is not None and key in self.extra:
+            del self.extra[key]
+            if not self.extra:
+                self.extra = None
+        else:
+            raise KeyError(key)
+    
+    def __iter__(self):
+        yield from Product.FIELDS
+        if self.extra is not None:
+            yield from self.extra
+    
+    def __len__(self) -> int:
+        return len(Product.FIELDS) + (len(self.extra) if self.extra is not None else 0)
+    
+    def __reduce__(self):
+        return Product, tuple(getattr(self, field) for field in Product.FIELDS), self.extra
+    
+    def __setstate__(self, state: Dict):
+        for key, value in state.items():
+            self[key] = value
+    
+    def __repr__(self) -> str:
+        return f"Product({self.to_dict()!r})"
+
+
+_TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+
+class SearchIndex:
+    """
+    Inverted token index over product name, type, sphere and tags, kept in
+    sync by ProductCatalog. Every query term must match the start of some
+    token of a product. A term's matching tokens are found by bisecting a
+    sorted vocabulary; the rarest term supplies the candidates, which the
+    other terms narrow by intersecting postings or, for very common terms,
+    by checking each candidate's own tokens.
+    """
+    
+    def __init__(self, products: List[Dict] = ()):
+        self._postings: Dict[str, set] = {}
+        self._vocabulary: List[str] = []
+        self._tokens: Dict[int, frozenset] = {}
+        for product in products:
+            self.add(product)
+    
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return _TOKEN_PATTERN.findall(text.lower())
+    
+    @staticmethod
+    def product_tokens(product: Dict) -> frozenset:
+        texts = [product["name"], product["type"], product["sphere"], *(product.get("tags") or ())]
+        return frozenset(token for text in texts if text for token in SearchIndex.tokenize(str(text)))
+    
+    def add(self, product: Dict):
+        product_id = product["id"]
+        tokens = self.product_tokens(product)
+        self._tokens[product_id] = tokens
+        for token in tokens:
+            posting = self._postings.get(token)
+            if posting is None:
+                posting = self._postings[token] = set()
+                bisect.insort(self._vocabulary, token)
+            posting.add(product_id)
+    
+    def remove(self, product_id: int):
+        for token in self._tokens.pop(product_id, ()):
+            posting = self._postings[token]
+            posting.discard(product_id)
+            if not posting:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+    
+    def replace(self, product: Dict):
+        self.remove(product["id"])
+        self.add(product)
+    
+    def _expansions(self, term: str) -> List[str]:
+        """Vocabulary tokens starting with term"""
+        upper = term[:-1] + chr(ord(term[-1]) + 1)
+        vocabulary = self._vocabulary
+        return vocabulary[bisect.bisect_left(vocabulary, term):bisect.bisect_left(vocabulary, upper)]
+    
+    def match(self, query: str) -> List[int]:
+        """Ids of products matching every term of query, in id order"""
+        return sorted(self.match_set(query))
+    
+    def match_set(self, query: str) -> set:
+        """Ids of products matching every term of query, unordered"""
+        terms = list(dict.fromkeys(self.tokenize(query)))
+        if not terms:
+            return set()
+        
+        expansions = {term: self._expansions(term) for term in terms}
+        sizes = {term: sum(len(self._postings[token]) for token in tokens)
+                 for term, tokens in expansions.items()}
+        rarest = min(terms, key=sizes.get)
+        if not sizes[rarest]:
+            return set()
+        
+        candidates = set().union(*(self._postings[token] for token in expansions[rarest]))
+        for term in sorted(terms, key=sizes.get)[1:]:
+            if sizes[term] <= 64 * len(candidates):
+                # cheaper to intersect with the term's postings than to check candidates one by one
+                candidates.intersection_update(set().union(*(self._postings[t] for t in expansions[term])))
+            else:
+                candidates = {product_id for product_id in candidates
+                              if any(token.startswith(term) for token in self._tokens[product_id])}
+            if not candidates:
+                break
+        return candidates
+
+
+class ProductFilter:
+    """
+    Conditions for ProductCatalog.query: an inclusive price range and, per
+    attribute (sphere, quality, price_level, delivery), the allowed values
+    as a string or a collection. None means no condition.
+    """
+    
+    ATTRIBUTES = ("sphere", "quality", "price_level", "delivery")
+    
+    def __init__(self, min_price: float = None, max_price: float = None, sphere=None,
+                 quality=None, price_level=None, delivery=None):
+        self.min_price = min_price
+        self.max_price = max_price
+        self.allowed: Dict[str, frozenset] = {}
+        for attribute, values in zip(self.ATTRIBUTES, (sphere, quality, price_level, delivery)):
+            if values is not None:
+                self.allowed[attribute] = frozenset([values] if isinstance(values, str) else values)
+    
+    @property
+    def has_price_range(self) -> bool:
+        return self.min_price is not None or self.max_price is not None
+    
+    def matches(self, product: Dict) -> bool:
+        price = product["price"]
+        if self.min_price is not None and price < self.min_price:
+            return False
+        if self.max_price is not None and price > self.max_price:
+            return False
+        return all(product[attribute] in values for attribute, values in self.allowed.items())
+
+
+class PriceIndex:
+    """Products sorted by (price, id), for bisect range queries"""
+    
+    def __init__(self, products: List[Dict] = ()):
+        self._keys = sorted((p["price"], p["id"]) for p in products)
+    
+    def add(self, product: Dict):
+        bisect.insort(self._keys, (product["price"], product["id"]))
+    
+    def remove(self, product: Dict):
+        key = (product["price"], product["id"])
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+    
+    def _bounds(self, min_price: float = None, max_price: float = None) -> Tuple[int, int]:
+        low = 0 if min_price is None else bisect.bisect_left(self._keys, (min_price, -np.inf))
+        high = len(self._keys) if max_price is None else bisect.bisect_right(self._keys, (max_price, np.inf))
+        return low, max(low, high)
+    
+    def count(self, min_price: float = None, max_price: float = None) -> int:
+        low, high = self._bounds(min_price, max_price)
+        return high - low
+    
+    def ids(self, min_price: float = None, max_price: float = None) -> List[int]:
+        """Ids of products priced within [min_price, max_price], cheapest first"""
+        low, high = self._bounds(min_price, max_price)
+        return [product_id for _, product_id in self._keys[low:high]]
+
+
+class Page:
+    """One page of a listing: its products and the cursor of the next page (None on the last)"""
+    
+    def __init__(self, products: List[Dict], next_cursor=None):
+        self.products = products
+        self.next_cursor = next_cursor
     
     @staticmethod
-    def calculate_product_score(user: User, product: Dict) -> float:
-        """Calculate final score for a product"""
-        sphere_score = user.sphere_scores.get(product["sphere"], 0.1)
+    def of(products, offset: int, size: int) -> 'Page':
+        """Page of an iterable starting at offset; only offset + size + 1 items are consumed"""
+        items = list(islice(products, offset, offset + size + 1))
+        return Page(items[:size], offset + size if len(items) > size else None)
+
+
+class ProductCatalog:
+    """
+    Product list with id, sphere, type, owner, tag, attribute and criteria
+    indexes kept in sync. The tag index is the inverted tag -> products
+    index used for candidate generation; the attribute indexes and a lazily
+    built PriceIndex answer filtered queries. Products are stored as compact
+    Product records.
+    """
+    
+    INDEXED_SHARE = 32
+    
+    def __init__(self, products: List[Dict] = ()):
+        self._by_id: Dict[int, Dict] = {}
+        self._by_sphere: Dict[str, Dict[int, Dict]] = {}
+        self._by_type: Dict[str, Dict[int, Dict]] = {}
+        self._by_owner: Dict[str, Dict[int, Dict]] = {}
+        self._by_tag: Dict[str, Dict[int, Dict]] = {}
+        self._by_criteria: Dict[Tuple, Dict[int, Dict]] = {}
+        self._by_attribute: Dict[str, Dict[str, Dict[int, Dict]]] = {
+            "sphere": self._by_sphere, "quality": {}, "price_level": {}, "delivery": {}
+        }
+        self._next_id = 1
+        self._matrix = None
+        self._search_index = None
+        self._price_index = None
+        self.decay = DecayState()
+        self.version = 0
+        
+        for product in products:
+            self.add(product)
+    
+    def _indexes(self, product: Dict):
+        """(index, key) pairs a product is filed under"""
+        yield self._by_sphere, product["sphere"]
+        yield self._by_type, product["type"]
+        yield self._by_owner, product["owner"]
+        for tag in set(product.get("tags") or ()):
+            yield self._by_tag, tag
+        yield self._by_criteria, (product["sphere"], product["quality"], product["price_level"], product["delivery"])
+        for attribute in ("quality", "price_level", "delivery"):
+            yield self._by_attribute[attribute], product[attribute]
+    
+    def add(self, product: Dict) -> 'Product':
+        """
+        Add a product to the catalog and every index, returning the stored
+        record; a product whose id is already listed replaces that record.
+        """
+        if product["id"] in self._by_id:
+            return self.replace(product)
+        product = Product.from_dict(product)
+        product_id = product["id"]
+        self._by_id[product_id] = product
+        for index, key in self._indexes(product):
+            index.setdefault(key, {})[product_id] = product
+        
+        self._next_id = max(self._next_id, product_id + 1)
+        if self._matrix is not None:
+            self._matrix.append(product)
+        if self._search_index is not None:
+            self._search_index.add(product)
+        if self._price_index is not None:
+            self._price_index.add(product)
+        self.version += 1
+        return product
+    
+    def replace(self, product: Dict) -> 'Product':
+        """Swap in a new version of an existing product, keeping its catalog position"""
+        product = Product.from_dict(product)
+        product_id = product["id"]
+        old = self._by_id[product_id]
         
-        sphere_score = sphere_score * (0.3 + user.initial_influence * 0.7)
+        for index, key in self._indexes(old):
+            bucket = index[key]
+            del bucket[product_id]
+            if not bucket:
+                del index[key]
+        self._by_id[product_id] = product
+        for index, key in self._indexes(product):
+            index.setdefault(key, {})[product_id] = product
         
-        seasonal_bonus = get_seasonal_bonus(product["sphere"])
-        sphere_score *= seasonal_bonus
+        if self._matrix is not None:
+            self._matrix.replace(product)
+        if self._search_index is not None:
+            self._search_index.replace(product)
+        if self._price_index is not None:
+            self._price_index.remove(old)
+            self._price_index.add(product)
+        self.version += 1
+        return product
+    
+    def remove(self, product_id: int):
+        """Remove a product by id, returning it (None if unknown)"""
+        product = self._by_id.pop(product_id, None)
+        if product is None:
+            return None
+        
+        for index, key in self._indexes(product):
+            bucket = index[key]
+            del bucket[product_id]
+            if not bucket:
+                del index[key]
+        
+        self.decay.forget(product_id)
+        if self._matrix is not None:
+            self._matrix.remove(product_id)
+        if self._search_index is not None:
+            self._search_index.remove(product_id)
+        if self._price_index is not None:
+            self._price_index.remove(product)
+        self.version += 1
+        return product
+    
+    def get(self, product_id: int):
+        """Product by id, or None"""
+        return self._by_id.get(product_id)
+    
+    def by_sphere(self, sphere: str) -> List[Dict]:
+        return list(self._by_sphere.get(sphere, {}).values())
+    
+    def by_type(self, product_type: str) -> List[Dict]:
+        return list(self._by_type.get(product_type, {}).values())
+    
+    def by_owner(self, owner: str) -> List[Dict]:
+        return list(self._by_owner.get(owner, {}).values())
+    
+    def by_tag(self, tag: str) -> List[Dict]:
+        return list(self._by_tag.get(tag, {}).values())
+    
+    def type_count(self, product_type: str) -> int:
+        return len(self._by_type.get(product_type, ()))
+    
+    def tag_count(self, tag: str) -> int:
+        return len(self._by_tag.get(tag, ()))
+    
+    def by_criteria(self, sphere: str, quality: str, price_level: str, delivery: str) -> List[Dict]:
+        return list(self._by_criteria.get((sphere, quality, price_level, delivery), {}).values())
+    
+    def spheres(self) -> List[str]:
+        """Sorted names of spheres that currently have products"""
+        return sorted(self._by_sphere)
+    
+    def sphere_count(self, sphere: str) -> int:
+        return len(self._by_sphere.get(sphere, ()))
+    
+    def next_id(self) -> int:
+        """Id for a new product; never reuses ids of removed products"""
+        return self._next_id
+    
+    def matrix(self) -> 'ProductMatrix':
+        """Vectorized encoding of the catalog, maintained incrementally once built"""
+        if self._matrix is None:
+            self._matrix = ProductMatrix(self._by_id.values())
+        return self._matrix
+    
+    def price_index(self) -> 'PriceIndex':
+        """Price-sorted index of the catalog, maintained incrementally once built"""
+        if self._price_index is None:
+            self._price_index = PriceIndex(self._by_id.values())
+        return self._price_index
+    
+    def query(self, product_filter: 'ProductFilter') -> List[Dict]:
+        """
+        Products matching product_filter, in id order. Starts from the most
+        selective condition (a price range or an attribute's buckets) and
+        keeps only ids present in the other conditions' indexes.
+        """
+        sources = []
+        for attribute, values in product_filter.allowed.items():
+            buckets = [self._by_attribute[attribute].get(value, {}) for value in values]
+            sources.append((sum(map(len, buckets)), attribute, buckets))
+        if product_filter.has_price_range:
+            prices = self.price_index()
+            sources.append((prices.count(product_filter.min_price, product_filter.max_price), "price", None))
+        if not sources:
+            return list(self._by_id.values())
+        sources.sort(key=lambda source: source[0])
+        
+        _, name, buckets = sources[0]
+        if name == "price":
+            ids = set(prices.ids(product_filter.min_price, product_filter.max_price))
+        else:
+            ids = set().union(*buckets)
+        for _, name, buckets in sources[1:]:
+            if not ids:
+                break
+            if name == "price":
+                low, high = product_filter.min_price, product_filter.max_price
+                ids = {i for i in ids if (low is None or self._by_id[i]["price"] >= low)
+                       and (high is None or self._by_id[i]["price"] <= high)}
+            elif len(buckets) == 1 and len(buckets[0]) < len(ids):
+                ids.intersection_update(buckets[0])
+            else:
+                ids = {i for i in ids if any(i in bucket for bucket in buckets)}
+        return [self._by_id[i] for i in sorted(ids)]
+    
+    def filter_rows(self, product_filter: 'ProductFilter') -> np.ndarray:
+        """
+        Ascending matrix rows of the products matching product_filter, so
+        only they need scoring. When the price index or an attribute's
+        buckets narrow the catalog to under 1/INDEXED_SHARE of it, just
+        those products' rows are looked up and checked against the other
+        conditions; otherwise the matrix columns are scanned.
+        """
+        matrix = self.matrix()
+        sources = []
+        for attribute, values in product_filter.allowed.items():
+            buckets = [self._by_attribute[attribute].get(value, {}) for value in values]
+            sources.append((sum(map(len, buckets)), buckets))
+        if product_filter.has_price_range:
+            prices = self.price_index()
+            sources.append((prices.count(product_filter.min_price, product_filter.max_price), None))
+        if not sources:
+            return np.flatnonzero(matrix.live)
+        
+        size, buckets = min(sources, key=lambda source: source[0])
+        if size * self.INDEXED_SHARE > len(self):
+            return np.flatnonzero(matrix.matching(product_filter))
+        if buckets is None:
+            ids = prices.ids(product_filter.min_price, product_filter.max_price)
+        else:
+            ids = chain.from_iterable(buckets)
+        rows = matrix.rows_for(ids)
+        return rows[matrix.matching(product_filter, rows)]
+    
+    def page(self, offset: int = 0, size: int = 10, sphere: str = None,
+             product_filter: 'ProductFilter' = None) -> 'Page':
+        """
+        One page of the catalog, a sphere, or the products matching
+        product_filter, in catalog order. The next cursor is the next offset.
+        """
+        if product_filter is not None:
+            return Page.of(self.query(product_filter), offset, size)
+        if sphere is not None:
+            return Page.of(self._by_sphere.get(sphere, {}).values(), offset, size)
+        return Page.of(self._by_id.values(), offset, size)
+    
+    def search_index(self) -> 'SearchIndex':
+        """Text index of the catalog, maintained incrementally once built"""
+        if self._search_index is None:
+            self._search_index = SearchIndex(self._by_id.values())
+        return self._search_index
+    
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+    
+    def __len__(self) -> int:
+        return len(self._by_id)
+    
+    def __contains__(self, product_id: int) -> bool:
+        return product_id in self._by_id
+
+
+class ScoringContext:
+    """
+    Per-request scoring inputs that are the same for every product: the
+    influence factor and, per sphere, the seasonal and recency multipliers.
+    The clock is read once; pass a fixed clock to score as of another time.
+    decay is the DecayState of the catalog being scored (None: no decay).
+    """
+    
+    def __init__(self, user: 'User', clock=datetime.now, decay: 'DecayState' = None):
+        self.user = user
+        self.decay = decay
+        self.now = clock()
+        self.influence = 0.3 + user.initial_influence * 0.7
+        self._sphere_scores: Dict[str, float] = {}
+        self._recency: Dict[str, float] = {}
+    
+    def sphere_score(self, sphere: str) -> float:
+        """User's sphere score with influence and seasonal bonus applied"""
+        score = self._sphere_scores.get(sphere)
+        if score is None:
+            score = self.user.sphere_scores.get(sphere, 0.1) * self.influence
+            score *= get_seasonal_bonus(sphere, self.now.month)
+            self._sphere_scores[sphere] = score
+        return score
+    
+    def recency(self, sphere: str) -> float:
+        """Boost for spheres never bought from (1.15) or not for over 30 days (1.10)"""
+        boost = self._recency.get(sphere)
+        if boost is None:
+            last_purchase = self.user.last_purchase_date.get(sphere)
+            if not last_purchase:
+                boost = 1.15
+            elif (self.now - datetime.fromisoformat(last_purchase)).days > 30:
+                boost = 1.10
+            else:
+                boost = 1.0
+            self._recency[sphere] = boost
+        return boost
+
+
+class ProductMatrix:
+    """
+    Column-encoded product list for vectorized scoring.
+    Rows are appended in catalog order; removed rows are tombstoned and
+    compacted once they make up half of the matrix.
+    """
+    
+    _COLUMNS = ("id", "sphere", "type", "quality", "price_level", "delivery", "tag_count", "price")
+    
+    def __init__(self, products: List[Dict]):
+        self.products: List = []
+        self.spheres: List[str] = []
+        self.types: List[str] = []
+        self.criteria: List = []
+        self.tags: List[str] = []
+        self.sphere_index: Dict[str, int] = {}
+        self._type_index: Dict[str, int] = {}
+        self._criteria_index: Dict = {}
+        self._tag_index: Dict[str, int] = {}
+        
+        self._row_of: Dict[int, int] = {}
+        self._size = 0
+        self._removed = 0
+        self._columns = {name: np.zeros(16, dtype=np.float64 if name == "price" else np.int32)
+                         for name in self._COLUMNS}
+        self._live = np.zeros(16, dtype=bool)
+        self._tag_ids = np.full((16, 0), -1, dtype=np.int32)
+        
+        for product in products:
+            self.append(product)
+    
+    @staticmethod
+    def _encode(value, vocabulary: List, index: Dict) -> int:
+        """Return the integer code of value, extending the vocabulary if needed"""
+        code = index.get(value)
+        if code is None:
+            code = len(vocabulary)
+            index[value] = code
+            vocabulary.append(value)
+        return code
+    
+    def append(self, product: Dict):
+        """Encode one product as a new row"""
+        row = self._size
+        if row == len(self._live):
+            self._resize(max(2 * row, row + 1, 16), self._tag_ids.shape[1])
+        self._write_row(row, product)
+        
+        self._live[row] = True
+        self._row_of[product["id"]] = row
+        self.products.append(product)
+        self._size += 1
+    
+    def replace(self, product: Dict):
+        """Re-encode the row of a product whose attributes changed"""
+        row = self._row_of.get(product["id"])
+        if row is not None:
+            self._tag_ids[row] = -1
+            self._write_row(row, product)
+            self.products[row] = product
+    
+    def _write_row(self, row: int, product: Dict):
+        tags = product.get("tags") or ()
+        if len(tags) > self._tag_ids.shape[1]:
+            self._resize(len(self._live), len(tags))
+        
+        columns = self._columns
+        columns["id"][row] = product["id"]
+        columns["sphere"][row] = self._encode(product["sphere"], self.spheres, self.sphere_index)
+        columns["type"][row] = self._encode(product["type"], self.types, self._type_index)
+        columns["quality"][row] = self._encode(product["quality"], self.criteria, self._criteria_index)
+        columns["price_level"][row] = self._encode(product["price_level"], self.criteria, self._criteria_index)
+        columns["delivery"][row] = self._encode(product["delivery"], self.criteria, self._criteria_index)
+        columns["tag_count"][row] = len(tags)
+        columns["price"][row] = product["price"]
+        for col, tag in enumerate(tags):
+            self._tag_ids[row, col] = self._encode(tag, self.tags, self._tag_index)
+    
+    def remove(self, product_id: int):
+        """Tombstone a product's row"""
+        row = self._row_of.pop(product_id, None)
+        if row is None:
+            return
+        self._live[row] = False
+        self.products[row] = None
+        self._removed += 1
+        if self._removed * 2 > self._size:
+            self._compact()
+    
+    def _resize(self, capacity: int, width: int):
+        for name, column in self._columns.items():
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            self._columns[name] = grown
+        live = np.zeros(capacity, dtype=bool)
+        live[:self._size] = self._live[:self._size]
+        self._live = live
+        tag_ids = np.full((capacity, width), -1, dtype=np.int32)
+        tag_ids[:self._size, :self._tag_ids.shape[1]] = self._tag_ids[:self._size]
+        self._tag_ids = tag_ids
+    
+    def _compact(self):
+        """Drop tombstoned rows, keeping catalog order"""
+        keep = self.live
+        for name, column in self._columns.items():
+            self._columns[name] = column[:self._size][keep]
+        self._tag_ids = self._tag_ids[:self._size][keep]
+        self.products = [p for p in self.products if p is not None]
+        self._size = len(self.products)
+        self._removed = 0
+        self._live = np.ones(self._size, dtype=bool)
+        self._row_of = {p["id"]: row for row, p in enumerate(self.products)}
+    
+    @property
+    def live(self) -> np.ndarray:
+        return self._live[:self._size]
+    
+    @property
+    def ids(self) -> np.ndarray:
+        return self._columns["id"][:self._size]
+    
+    @property
+    def sphere_codes(self) -> np.ndarray:
+        return self._columns["sphere"][:self._size]
+    
+    @property
+    def type_codes(self) -> np.ndarray:
+        return self._columns["type"][:self._size]
+    
+    @property
+    def quality_codes(self) -> np.ndarray:
+        return self._columns["quality"][:self._size]
+    
+    @property
+    def price_level_codes(self) -> np.ndarray:
+        return self._columns["price_level"][:self._size]
+    
+    @property
+    def delivery_codes(self) -> np.ndarray:
+        return self._columns["delivery"][:self._size]
+    
+    @property
+    def tag_counts(self) -> np.ndarray:
+        return self._columns["tag_count"][:self._size]
+    
+    @property
+    def tag_ids(self) -> np.ndarray:
+        return self._tag_ids[:self._size]
+    
+    @property
+    def prices(self) -> np.ndarray:
+        return self._columns["price"][:self._size]
+    
+    def matching(self, product_filter: 'ProductFilter', rows: np.ndarray = None) -> np.ndarray:
+        """Boolean mask of the live rows (or of rows) whose product matches product_filter"""
+        if rows is None:
+            rows = slice(0, self._size)
+        mask = self._live[rows]
+        if product_filter.min_price is not None:
+            mask = mask & (self._columns["price"][rows] >= product_filter.min_price)
+        if product_filter.max_price is not None:
+            mask = mask & (self._columns["price"][rows] <= product_filter.max_price)
+        for attribute, values in product_filter.allowed.items():
+            index = self.sphere_index if attribute == "sphere" else self._criteria_index
+            codes = [index[value] for value in values if value in index]
+            mask = mask & np.isin(self._columns[attribute][rows], codes)
+        return mask
+    
+    def sphere_rows(self, sphere: str) -> np.ndarray:
+        """Live rows of a sphere's products, in row order"""
+        code = self.sphere_index.get(sphere)
+        if code is None:
+            return np.empty(0, dtype=np.intp)
+        return np.flatnonzero((self.sphere_codes == code) & self.live)
+    
+    def rows_for(self, product_ids) -> np.ndarray:
+        """Ascending rows of the given product ids (ids not in the matrix are ignored)"""
+        ids = np.fromiter(product_ids, dtype=np.int64)
+        if len(ids) * 8 > self._size:
+            # many ids: one vectorized membership test beats a dict lookup per id
+            return np.flatnonzero(np.isin(self.ids, ids) & self.live)
+        row_of = self._row_of
+        rows = np.fromiter((row_of[i] for i in ids.tolist() if i in row_of), dtype=np.intp)
+        rows.sort()
+        return rows
+    
+    def rows_of(self, products) -> np.ndarray:
+        """Boolean mask of the rows holding products (ones not in the matrix are ignored)"""
+        mask = np.zeros(self._size, dtype=bool)
+        rows = [self._row_of[p["id"]] for p in products if p["id"] in self._row_of]
+        mask[rows] = True
+        return mask
+    
+    def __len__(self) -> int:
+        return self._size - self._removed
+    
+    def score(self, user: 'User', context: 'ScoringContext' = None, rows: np.ndarray = None,
+              recency: bool = True) -> np.ndarray:
+        """
+        Score every product (or the given rows) for user in one array expression.
+        Mirrors calculate_product_score plus the recency and decay
+        multipliers of get_recommendations, in the same operation order;
+        recency=False and a context without decay give calculate_product_score.
+        """
+        contexts = [context] if context is not None else None
+        return self.score_batch([user], contexts=contexts, rows=rows, recency=recency)[0]
+    
+    def score_batch(self, users: List['User'], max_cells: int = 2_000_000,
+                    contexts: List['ScoringContext'] = None, clock=datetime.now,
+                    decay: 'DecayState' = None, rows: np.ndarray = None, recency: bool = True) -> np.ndarray:
+        """
+        Score every product for every user, returning a users x products matrix.
+        Without contexts, every user is scored as of a single clock reading
+        with decay; with contexts, the first one's decay applies. With rows
+        (ascending row indices), only those rows are scored.
+        See iter_score_batch for scoring many users in bounded memory.
+        """
+        size = self._size if rows is None else len(rows)
+        scores = np.empty((len(users), size))
+        for start, block in self.iter_score_batch(users, max_cells, contexts, clock, decay, rows, recency):
+            scores[start:start + len(block)] = block
+        return scores
+    
+    def iter_score_batch(self, users: List['User'], max_cells: int = 2_000_000,
+                         contexts: List['ScoringContext'] = None, clock=datetime.now,
+                         decay: 'DecayState' = None, rows: np.ndarray = None, recency: bool = True):
+        """
+        Yield (first user index, block) for consecutive chunks of users, each
+        block the chunk's users x products scores. Users are stacked into
+        preference matrices and gathered against the product code columns
+        in chunks of at most max_cells tag lookups, so a consumer that drops
+        each block holds only one chunk's scores at a time.
+        """
+        if contexts is None:
+            now = clock()
+            contexts = [ScoringContext(user, lambda: now, decay) for user in users]
+        if not contexts:
+            return
+        sphere_values, recency_values, criteria_values, type_values, tag_values = (
+            np.array(vectors).reshape(len(users), -1)
+            for vectors in zip(*(self._user_vectors(context) for context in contexts))
+        )
+        # gathering the code columns costs more than scoring the rows it skips past half the matrix
+        subset = rows if rows is not None and len(rows) * 2 <= self._size else None
+        codes = self._codes(subset)
+        decay = contexts[0].decay.gather(codes["id"]) if contexts[0].decay is not None else 1.0
+        
+        size = len(codes["id"])
+        chunk = max(1, max_cells // max(1, size * codes["tag_ids"].shape[1]))
+        for start in range(0, len(users), chunk):
+            users_slice = slice(start, start + chunk)
+            block = (
+                sphere_values[users_slice][:, codes["sphere"]] * 0.35 +
+                criteria_values[users_slice][:, codes["quality"]] * 0.15 +
+                criteria_values[users_slice][:, codes["price_level"]] * 0.15 +
+                criteria_values[users_slice][:, codes["delivery"]] * 0.10 +
+                self._tag_scores(tag_values[users_slice], codes["tag_ids"], codes["tag_count"]) * 0.15 +
+                type_values[users_slice][:, codes["type"]] * 0.10
+            )
+            if recency:
+                block *= recency_values[users_slice][:, codes["sphere"]]
+            block *= decay
+            yield start, block if subset is not None or rows is None else block[:, rows]
+    
+    def _codes(self, rows: np.ndarray = None) -> Dict[str, np.ndarray]:
+        """Code columns plus tag ids of all rows, or gathered at rows"""
+        codes = {name: self._columns[name][:self._size] for name in self._COLUMNS if name != "price"}
+        codes["tag_ids"] = self.tag_ids
+        if rows is not None:
+            codes = {name: column[rows] for name, column in codes.items()}
+        return codes
+    
+    def _user_vectors(self, context: 'ScoringContext') -> Tuple[List[float], ...]:
+        """Lookup tables of one user's preferences, aligned with the vocabularies"""
+        user = context.user
+        sphere_values = [context.sphere_score(s) for s in self.spheres]
+        recency = [context.recency(s) for s in self.spheres]
+        
+        criteria_values = [user.criteria_scores.get(c, 0.1) for c in self.criteria]
+        type_values = [user.type_scores.get(t, 0.1) for t in self.types]
+        # Padding slots hold -1, which picks the trailing -inf entry
+        tag_values = [user.tag_scores.get(t, 0.1) for t in self.tags] + [-np.inf]
+        return sphere_values, recency, criteria_values, type_values, tag_values
+    
+    @staticmethod
+    def _tag_scores(tag_values: np.ndarray, tag_ids: np.ndarray, tag_counts: np.ndarray) -> np.ndarray:
+        """
+        Mean of the two best tag scores per product (users x products).
+        Tag slots are folded in one column at a time, keeping the running
+        best and second best, so no users x products x slots array is built.
+        """
+        tag_score = np.full((len(tag_values), len(tag_ids)), 0.1)
+        width = tag_ids.shape[1]
+        if width:
+            best = tag_values[:, tag_ids[:, 0]]
+            second = np.full_like(best, -np.inf)
+            for slot in range(1, width):
+                values = tag_values[:, tag_ids[:, slot]]
+                np.maximum(second, np.minimum(best, values), out=second)
+                np.maximum(best, values, out=best)
+            tag_score = np.where(tag_counts >= 2, (best + second) / 2, tag_score)
+            tag_score = np.where(tag_counts == 1, best, tag_score)
+        return tag_score
+
+
+def top_positions(scores: np.ndarray, count: int, ties: np.ndarray = None) -> np.ndarray:
+    """
+    Positions of the count highest scores, best first; equal scores keep
+    their positional order, like a stable descending sort, or the order of
+    their ties values. Uses a partition, so only positions tied with the
+    count-th best score are sorted.
+    """
+    if count <= 0:
+        return np.empty(0, dtype=np.intp)
+    positions = np.arange(len(scores))
+    if len(scores) > count:
+        kth = np.partition(scores, len(scores) - count)[len(scores) - count]
+        positions = np.flatnonzero(scores >= kth)
+        scores = scores[positions]
+    order = positions if ties is None else ties[positions]
+    return positions[np.lexsort((order, -scores))][:count]
+
+
+def top_rows(rows: np.ndarray, scores: np.ndarray, count: int) -> np.ndarray:
+    """The count rows with the highest scores, best first (see top_positions)"""
+    return rows[top_positions(scores, count)]
+
+
+class SphereGroups:
+    """
+    Matrix rows grouped by sphere for per-sphere selection: order sorts the
+    rows stably by sphere code, so each sphere's rows (in row order) are the
+    slice slices[code] of rows[order]. Built once per set of rows and shared
+    by every user scored over them.
+    """
+    
+    def __init__(self, matrix: 'ProductMatrix', rows: np.ndarray):
+        spheres = matrix.sphere_codes[rows]
+        self.order = np.argsort(spheres, kind="stable")
+        self.rows = rows[self.order]
+        codes, starts, sizes = np.unique(spheres[self.order], return_index=True, return_counts=True)
+        self.slices: Dict[int, slice] = {
+            int(code): slice(int(start), int(start + size)) for code, start, size in zip(codes, starts, sizes)
+        }
+
+
+class RecommendationEngine:
+    """Core recommendation algorithm"""
+    
+    @staticmethod
+    def calculate_product_score(user: User, product: Dict, context: ScoringContext = None) -> float:
+        """
+        Calculate final score for a product.
+        Pass the request's ScoringContext when scoring many products.
+        """
+        if context is None:
+            context = ScoringContext(user)
+        sphere_score = context.sphere_score(product["sphere"])
         
         quality_score = user.criteria_scores.get(product["quality"], 0.1)
         price_score = user.criteria_scores.get(product["price_level"], 0.1)
@@ -730,44 +2877,249 @@ class RecommendationEngine:
         return final_score
     
     @staticmethod
-    def get_recommendations(user: User, products: List[Dict], count: int = 30) -> List[Dict]:
-        """Get personalized recommendations - interleaved by sphere for perfect balance"""
-        scored_products = []
+    def get_recommendations(user: User, products: List[Dict], count: int = 30,
+                            matrix: ProductMatrix = None, selection: str = "heap",
+                            clock=datetime.now, candidates: 'CandidateGenerator' = None,
+                            filters: 'ProductFilter' = None) -> List[Dict]:
+        """
+        Get personalized recommendations - interleaved by sphere for perfect balance.
+        Pass a ProductMatrix built from products to score the catalog vectorized;
+        a ProductCatalog is scored through its own maintained matrix.
+        selection="heap" keeps only the best candidates per sphere while scoring;
+        selection="sort" fully sorts the scored catalog (reference implementation).
+        clock supplies the time seasonal and recency effects are evaluated at.
+        With a CandidateGenerator, only the matrix rows of its candidates from
+        the catalog are scored (exactly), which needs products to be a
+        ProductCatalog. With a ProductFilter, only matching products are
+        recommended; they are resolved to matrix rows first (through the
+        catalog indexes where selective) and only those rows are scored.
+        """
+        decay = products.decay if isinstance(products, ProductCatalog) else None
+        context = ScoringContext(user, clock, decay)
+        top_spheres = RecommendationEngine._top_spheres(user)
+        max_per_sphere = (count // len(top_spheres)) + 2
         
-        for p in products:
-            base_score = RecommendationEngine.calculate_product_score(user, p)
-            
-            sphere = p["sphere"]
-            last_purchase = user.last_purchase_date.get(sphere)
-            
-            if last_purchase:
-                days_ago = (datetime.now() - datetime.fromisoformat(last_purchase)).days
-                if days_ago > 30:
-                    base_score *= 1.10
+        if matrix is None:
+            if isinstance(products, ProductCatalog):
+                matrix = products.matrix()
+            elif filters is not None:
+                products = [p for p in products if filters.matches(p)]
+        
+        if matrix is not None:
+            if candidates is not None:
+                rows = matrix.rows_for(p["id"] for p in candidates.generate(user, products))
+                rows = rows[matrix.live[rows] if filters is None else matrix.matching(filters, rows)]
+            elif filters is not None:
+                rows = RecommendationEngine._filter_rows(products, matrix, filters)
             else:
-                base_score *= 1.15
+                rows = np.flatnonzero(matrix.live)
+            scores = matrix.score(user, context, rows=rows)
+            products_by_sphere, other_products = RecommendationEngine._select_from_scores(
+                matrix, scores, top_spheres, max_per_sphere, count, rows
+            )
+        elif selection == "sort":
+            scored_products = list(RecommendationEngine._iter_scored(context, products))
+            scored_products.sort(key=lambda x: x[1], reverse=True)
             
-            if "decay_score" in p:
-                base_score *= p["decay_score"]
+            products_by_sphere = {}
+            for sphere in top_spheres:
+                products_by_sphere[sphere] = [p for p, s in scored_products if p["sphere"] == sphere]
             
-            p["_score"] = base_score
-            scored_products.append((p, base_score))
-        
-        scored_products.sort(key=lambda x: x[1], reverse=True)
+            other_products = [p for p, s in scored_products if p["sphere"] not in top_spheres]
+        else:
+            products_by_sphere, other_products = RecommendationEngine._select_with_heaps(
+                RecommendationEngine._iter_scored(context, products), top_spheres, max_per_sphere, count
+            )
         
-        sorted_spheres = sorted(
-            user.sphere_scores.items(),
-            key=lambda x: x[1],
-            reverse=True
+        return RecommendationEngine._interleave_by_sphere(
+            top_spheres, products_by_sphere, other_products, count
         )
-        top_spheres = [s[0] for s in sorted_spheres[:5]]
+    
+    @staticmethod
+    def get_recommendations_batch(users: List[User], products: List[Dict], count: int = 30,
+                                  matrix: ProductMatrix = None, clock=datetime.now) -> Dict[str, List[Dict]]:
+        """
+        Get recommendations for many users at once, keyed by username.
+        Users are scored in chunks (ProductMatrix.iter_score_batch) and each
+        chunk's picks are selected before the next is scored, so memory is
+        bounded by one chunk of scores, not users x products.
+        """
+        if not users:
+            return {}
+        if matrix is None:
+            matrix = products.matrix() if isinstance(products, ProductCatalog) else ProductMatrix(products)
+        
+        decay = products.decay if isinstance(products, ProductCatalog) else None
+        rows = np.flatnonzero(matrix.live)
+        groups = SphereGroups(matrix, rows)
+        results = {}
+        for start, block in matrix.iter_score_batch(users, clock=clock, decay=decay, rows=rows):
+            for user, user_scores in zip(users[start:start + len(block)], block):
+                top_spheres = RecommendationEngine._top_spheres(user)
+                max_per_sphere = (count // len(top_spheres)) + 2
+                products_by_sphere, other_products = RecommendationEngine._select_from_scores(
+                    matrix, user_scores, top_spheres, max_per_sphere, count, rows, groups
+                )
+                results[user.username] = RecommendationEngine._interleave_by_sphere(
+                    top_spheres, products_by_sphere, other_products, count
+                )
+        return results
+    
+    @staticmethod
+    def _filter_rows(products, matrix: ProductMatrix, filters: 'ProductFilter') -> np.ndarray:
+        """Rows of matrix matching filters, through the catalog's indexes when matrix is its own"""
+        if isinstance(products, ProductCatalog) and matrix is products.matrix():
+            return products.filter_rows(filters)
+        return np.flatnonzero(matrix.matching(filters))
+    
+    @staticmethod
+    def recommendation_page(user: User, catalog: 'ProductCatalog', size: int = 10, cursor: Tuple = None,
+                            filters: 'ProductFilter' = None, clock=datetime.now) -> 'Page':
+        """
+        One page of the catalog in descending score order (recency and decay
+        applied, ties by id), for open-ended "more like this" listings.
+        cursor is the (score, id) of the last product already shown, as
+        returned in the previous page's next_cursor; it needs no server-side
+        state, and products added or removed in between are picked up.
+        """
+        matrix = catalog.matrix()
+        rows = np.flatnonzero(matrix.live) if filters is None else catalog.filter_rows(filters)
+        scores = matrix.score(user, ScoringContext(user, clock, catalog.decay), rows=rows)
+        ids = matrix.ids[rows]
+        if cursor is not None:
+            last_score, last_id = cursor
+            after = (scores < last_score) | ((scores == last_score) & (ids > last_id))
+            rows, scores, ids = rows[after], scores[after], ids[after]
+        
+        if len(rows) > size:
+            # keep every row tied with the size-th best score so ties are broken by id below
+            kth = np.partition(scores, len(rows) - size)[len(rows) - size]
+            chosen = np.flatnonzero(scores >= kth)
+        else:
+            chosen = np.arange(len(rows))
+        chosen = chosen[np.lexsort((ids[chosen], -scores[chosen]))][:size]
+        
+        next_cursor = None
+        if len(rows) > size:
+            next_cursor = (float(scores[chosen[-1]]), int(ids[chosen[-1]]))
+        chosen = rows[chosen]
+        return Page([matrix.products[row] for row in chosen], next_cursor)
+    
+    @staticmethod
+    def search(user: User, catalog: 'ProductCatalog', query: str, count: int = 20,
+               filters: 'ProductFilter' = None) -> List[Dict]:
+        """
+        Products matching every term of query (as word prefixes of name, type,
+        sphere or tags) and filters, ranked by calculate_product_score for
+        user (by id without a user; ties by id). Matches are scored as matrix
+        rows and the best picked by partition.
+        """
+        ids = catalog.search_index().match_set(query)
+        if user is None and filters is None:
+            return [catalog.get(product_id) for product_id in heapq.nsmallest(count, ids)]
+        
+        matrix = catalog.matrix()
+        rows = matrix.rows_for(ids)
+        if filters is not None:
+            rows = rows[matrix.matching(filters, rows)]
+        if user is None:
+            rows = rows[np.argsort(matrix.ids[rows], kind="stable")[:count]]
+        else:
+            scores = matrix.score(user, ScoringContext(user), rows=rows, recency=False)
+            rows = rows[top_positions(scores, count, ties=matrix.ids[rows])]
+        return [matrix.products[row] for row in rows]
+    
+    @staticmethod
+    def _select_from_scores(matrix: ProductMatrix, scores: np.ndarray, top_spheres: List[str],
+                            max_per_sphere: int, count: int, rows: np.ndarray = None,
+                            groups: 'SphereGroups' = None) -> Tuple[Dict[str, List[Dict]], List[Dict]]:
+        """
+        Best products per top sphere plus the best remaining products, by
+        score. scores belong to rows (ascending row indices); without rows
+        they cover the whole matrix and only live rows are considered.
+        Each sphere is selected by partition (top_positions) within its group of
+        rows; pass the SphereGroups of rows when selecting for many users.
+        """
+        if rows is None:
+            rows = np.flatnonzero(matrix.live)
+            scores = scores[rows]
+        if groups is None:
+            groups = SphereGroups(matrix, rows)
+        scores = scores[groups.order]
         
         products_by_sphere = {}
         for sphere in top_spheres:
-            products_by_sphere[sphere] = [p for p, s in scored_products if p["sphere"] == sphere]
+            group = groups.slices.get(matrix.sphere_index.get(sphere))
+            chosen = top_rows(groups.rows[group], scores[group], max_per_sphere) if group else []
+            products_by_sphere[sphere] = [matrix.products[i] for i in chosen]
         
-        other_products = [p for p, s in scored_products if p["sphere"] not in top_spheres]
+        # best of each other sphere, then the best of those in row order
+        top_codes = {matrix.sphere_index.get(sphere) for sphere in top_spheres}
+        positions = [group.start + top_positions(scores[group], count)
+                     for code, group in groups.slices.items() if code not in top_codes]
+        positions = np.concatenate(positions) if positions else np.empty(0, dtype=np.intp)
+        positions = positions[np.argsort(groups.rows[positions], kind="stable")]
+        other_rows = groups.rows[positions[top_positions(scores[positions], count)]]
+        other_products = [matrix.products[i] for i in other_rows]
+        return products_by_sphere, other_products
+    
+    @staticmethod
+    def _iter_scored(context: ScoringContext, products: List[Dict]):
+        """Yield (product, score) with recency and decay applied"""
+        user = context.user
+        decay = context.decay
+        for p in products:
+            base_score = RecommendationEngine.calculate_product_score(user, p, context)
+            base_score *= context.recency(p["sphere"])
+            if decay is not None:
+                base_score *= decay.multiplier(p["id"])
+            yield p, base_score
+    
+    @staticmethod
+    def _select_with_heaps(scored_products, top_spheres: List[str], max_per_sphere: int,
+                           count: int) -> Tuple[Dict[str, List[Dict]], List[Dict]]:
+        """
+        Partial top-K selection: a bounded min-heap per top sphere plus one
+        overflow heap for other spheres, O(N log K) instead of a full sort.
+        Entries carry the negated input position so ties resolve exactly
+        like the stable descending sort.
+        """
+        heaps = {sphere: [] for sphere in top_spheres}
+        overflow = []
+        
+        for position, (p, score) in enumerate(scored_products):
+            heap = heaps.get(p["sphere"])
+            limit = max_per_sphere
+            if heap is None:
+                heap, limit = overflow, count
+            
+            entry = (score, -position, p)
+            if len(heap) < limit:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
         
+        products_by_sphere = {
+            sphere: [p for _, _, p in sorted(heap, reverse=True)]
+            for sphere, heap in heaps.items()
+        }
+        other_products = [p for _, _, p in sorted(overflow, reverse=True)]
+        return products_by_sphere, other_products
+    
+    @staticmethod
+    def _top_spheres(user: User) -> List[str]:
+        """User's five highest-scored spheres"""
+        sorted_spheres = sorted(
+            user.sphere_scores.items(),
+            key=lambda x: x[1],
+            reverse=True
+        )
+        return [s[0] for s in sorted_spheres[:5]]
+    
+    @staticmethod
+    def _interleave_by_sphere(top_spheres: List[str], products_by_sphere: Dict[str, List[Dict]],
+                              other_products: List[Dict], count: int) -> List[Dict]:
+        """Round-robin over the top spheres' score-ordered lists, padding with other products"""
         recommendations = []
         sphere_indices = {s: 0 for s in top_spheres}
         max_per_sphere = (count // len(top_spheres)) + 2
@@ -800,111 +3152,493 @@ class RecommendationEngine:
         
         return recommendations[:count]
     
-    @staticmethod
-    def update_profile_after_purchase(user: User, product: Dict, was_recommended: bool):
-        """
-        FIXED: Added hard caps to prevent infinite score growth
-        """
-        sphere = product["sphere"]
+    @staticmethod
+    def update_profile_after_purchase(user: User, product: Dict, was_recommended: bool, when: str = None):
+        """
+        Learn one purchase into user's profile. when (ISO date, default now)
+        becomes the sphere's last purchase date. The learning rules live in
+        ProfileReplay, which also replays whole purchase histories.
+        """
+        purchase = purchase_features(product, was_recommended)
+        purchase["date"] = when if when is not None else datetime.now().isoformat()
+        
+        replay = ProfileReplay(user)
+        replay.apply(purchase)
+        replay.finish()
+        
+        cancel_sphere_decay(product["sphere"])
+
+
+def purchase_features(product: Dict, was_recommended: bool) -> Dict:
+    """What the profile update learns from a purchase; stored with purchase and transaction records"""
+    return {
+        "sphere": product["sphere"],
+        "type": product["type"],
+        "quality": product["quality"],
+        "price_level": product["price_level"],
+        "delivery": product["delivery"],
+        "tags": list(product.get("tags", [])),
+        "recommended": was_recommended
+    }
+
+
+class ProfileReplay:
+    """
+    Learns a stream of purchases into one user's profile, with the same
+    final state as learning them one update_profile_after_purchase call at
+    a time but without its per-call cost. The 0.98 decay of spheres not
+    bought is owed per sphere and settled only when the sphere is touched
+    again or at finish(), stopping early once it sits at the 0.3 floor; the
+    criteria groups and initial influence are updated on local copies and
+    written back once.
+    
+    Purchases are records with the purchase_features keys plus "date";
+    records from before price_level, delivery, tags and recommended were
+    stored learn only the fields they have. interests are questionnaire
+    answers ({"spheres": [...], "date": ...}), merged into the stream by date.
+    """
+    
+    CRITERIA_GROUPS = (("quality", QUALITY_CRITERIA), ("price_level", PRICE_CRITERIA),
+                       ("delivery", DELIVERY_CRITERIA))
+    INFLUENCE_DECAY = {"0-13": 0.98, "14-18": 0.92, "19-30": 0.90, "31-50": 0.93, "50+": 0.96}
+    
+    def __init__(self, user: User, interests=()):
+        self.user = user
+        self.purchases = 0
+        self._scores = user.sphere_scores
+        self._settled = {}  # sphere -> number of purchases its decay is settled up to
+        self._criteria = [[user.criteria_scores[c] for c in group] for _, group in self.CRITERIA_GROUPS]
+        self._influence = user.initial_influence
+        self._influence_decay = self.INFLUENCE_DECAY[user._get_age_group()]
+        self._interests = sorted(interests, key=lambda answer: answer["date"])
+        self._next_interest = 0
+        self.sphere_purchases: Dict[str, int] = {}
+    
+    def _settle(self, sphere: str):
+        """Apply the decay sphere owes for the purchases since it was last touched"""
+        owed = self.purchases - self._settled.get(sphere, 0)
+        score = self._scores[sphere]
+        while owed and score != 0.3:
+            score = max(0.3, score * 0.98)
+            owed -= 1
+        self._scores[sphere] = score
+        self._settled[sphere] = self.purchases
+    
+    def _apply_interests(self, before=None):
+        """Apply the questionnaire answers dated before `before` (all of them if None)"""
+        while (self._next_interest < len(self._interests) and
+               (before is None or self._interests[self._next_interest]["date"] < before)):
+            self.boost(self._interests[self._next_interest]["spheres"])
+            self._next_interest += 1
+    
+    def boost(self, spheres: List[str]):
+        """A questionnaire answer: +0.15 for each sphere, 0.15 for spheres new to the profile"""
+        for sphere in spheres:
+            if sphere in self._scores:
+                self._settle(sphere)
+                self._scores[sphere] = min(self._scores[sphere] + 0.15, MAX_SPHERE_SCORE)
+            else:
+                self._scores[sphere] = 0.15
+                self._settled[sphere] = self.purchases
+    
+    def apply(self, purchase: Dict):
+        """Learn one purchase record"""
+        sphere = purchase["sphere"]
+        if sphere not in self._scores:
+            raise ValueError(f"Unknown sphere: {sphere}")
+        chosen = []
+        for field, group in self.CRITERIA_GROUPS:
+            value = purchase.get(field)
+            if value is not None and value not in group:
+                raise ValueError(f"Invalid {field}: {value}")
+            chosen.append(value)
         
-        if was_recommended:
-            increase = 0.15
-        else:
-            increase = 0.1
+        date = purchase.get("date")
+        if date is not None:
+            self._apply_interests(date)
         
-        user.sphere_scores[sphere] = min(
-            user.sphere_scores[sphere] + increase,
-            MAX_SPHERE_SCORE  # Hard cap at 5.0
-        )
+        self._settle(sphere)
+        self.sphere_purchases[sphere] = self.sphere_purchases.get(sphere, 0) + 1
+        increase = 0.15 if purchase.get("recommended") else 0.1
+        self._scores[sphere] = min(self._scores[sphere] + increase, MAX_SPHERE_SCORE)
+        self.purchases += 1
+        self._settled[sphere] = self.purchases
         
-        quality = product["quality"]
-        price_level = product["price_level"]
-        delivery = product["delivery"]
+        for (_, group), values, value in zip(self.CRITERIA_GROUPS, self._criteria, chosen):
+            if value is None:
+                continue
+            for i, criterion in enumerate(group):
+                if criterion == value:
+                    values[i] = min(values[i] + 0.1, MAX_CRITERIA_SCORE)
+                else:
+                    values[i] = max(0.2, values[i] - 0.05)
+            
+            # normalize_criteria_group on the local copy
+            total = sum(values)
+            if total > 3.0:
+                factor = 3.0 / total
+                values[:] = [max(0.2, min(score * factor, MAX_CRITERIA_SCORE)) for score in values]
+            else:
+                values[:] = [max(0.2, score) for score in values]
         
-        user.criteria_scores[quality] = min(
-            user.criteria_scores[quality] + 0.1,
-            MAX_CRITERIA_SCORE  # Hard cap at 3.0
-        )
-        user.criteria_scores[price_level] = min(
-            user.criteria_scores[price_level] + 0.1,
-            MAX_CRITERIA_SCORE
-        )
-        user.criteria_scores[delivery] = min(
-            user.criteria_scores[delivery] + 0.1,
-            MAX_CRITERIA_SCORE
-        )
+        if self._influence > 0.2:
+            self._influence *= self._influence_decay
         
-        for criterion in QUALITY_CRITERIA:
-            if criterion != quality:
-                user.criteria_scores[criterion] = max(0.2, user.criteria_scores[criterion] - 0.05)
+        tag_scores = self.user.tag_scores
+        for tag in purchase.get("tags", ()):
+            if tag in tag_scores:
+                tag_scores[tag] = min(tag_scores[tag] + 0.15, MAX_TAG_SCORE)
+            else:
+                tag_scores[tag] = 0.15
         
-        for criterion in PRICE_CRITERIA:
-            if criterion != price_level:
-                user.criteria_scores[criterion] = max(0.2, user.criteria_scores[criterion] - 0.05)
+        type_scores = self.user.type_scores
+        product_type = purchase["type"]
+        if product_type in type_scores:
+            type_scores[product_type] = min(type_scores[product_type] + 0.3, MAX_TYPE_SCORE)
+        else:
+            type_scores[product_type] = 0.3
         
-        for criterion in DELIVERY_CRITERIA:
-            if criterion != delivery:
-                user.criteria_scores[criterion] = max(0.2, user.criteria_scores[criterion] - 0.05)
+        if date is not None:
+            self.user.last_purchase_date[sphere] = date
+    
+    def finish(self) -> User:
+        """Apply the remaining interests, settle every sphere and write the profile back"""
+        self._apply_interests()
+        for sphere in list(self._scores):
+            self._settle(sphere)
+        for (_, group), values in zip(self.CRITERIA_GROUPS, self._criteria):
+            self.user.criteria_scores.update(zip(group, values))
+        self.user.initial_influence = self._influence
+        self.user.bump_profile_version()
+        return self.user
+    
+    @staticmethod
+    def replay(user: User, purchases) -> User:
+        """Learn purchases, in order, on top of user's current profile"""
+        replay = ProfileReplay(user)
+        for purchase in purchases:
+            replay.apply(purchase)
+        return replay.finish()
+    
+    @staticmethod
+    def answers_missing(user: User, sphere_scores: Dict[str, float], sphere_purchases: Dict[str, int]) -> bool:
+        """
+        Whether sphere_scores (user's profile before a rebuild) carry
+        questionnaire boosts that user.interest_answers doesn't hold, as for
+        users who answered before the answers were logged. Each purchase or
+        logged answer adds at most 0.15 to a sphere and only answers add
+        spheres, so a sphere outside the demographic profile without a
+        logged answer, or above its demographic score by more than its
+        purchases and logged answers could add, gives them away.
+        """
+        boosts = dict(sphere_purchases)
+        for answer in user.interest_answers:
+            for sphere in answer["spheres"]:
+                boosts[sphere] = boosts.get(sphere, 0) + 1
+        demographic = user._init_sphere_scores(user._get_age_group(), user.gender)
+        for sphere, score in sphere_scores.items():
+            # purchase decay lifts scores below its 0.3 floor
+            if score > max(demographic.get(sphere, 0.0), 0.3) + 0.15 * boosts.get(sphere, 0) + 1e-9:
+                return True
+        return False
+    
+    @staticmethod
+    def rebuild(user: User, purchases=None) -> User:
+        """
+        Recompute user's profile from scratch: the demographic profile, then
+        the questionnaire answers and purchases (default: the purchase
+        history) in date order. Raises ValueError, leaving the profile as it
+        is, if it shows questionnaire answers from before they were logged.
+        """
+        if purchases is None:
+            purchases = user.purchase_history
+        counts = {}
+        for purchase in purchases:
+            counts[purchase["sphere"]] = counts.get(purchase["sphere"], 0) + 1
+        if ProfileReplay.answers_missing(user, user.sphere_scores, counts):
+            raise ValueError(f"{user.username} answered the questionnaire before answers were logged")
         
-        normalize_criteria_group(user, QUALITY_CRITERIA)
-        normalize_criteria_group(user, PRICE_CRITERIA)
-        normalize_criteria_group(user, DELIVERY_CRITERIA)
+        user.reset_preferences()
+        replay = ProfileReplay(user, user.interest_answers)
+        for purchase in purchases:
+            replay.apply(purchase)
+        return replay.finish()
+    
+    @staticmethod
+    def rebuild_all(db) -> Dict[str, int]:
+        """
+        Recompute the profile of every buyer in db's transaction log in one
+        streaming pass, e.g. after a fix to the learning rules; run it with
+        the marketplace stopped. Buyers with transactions from before
+        purchases carried their product fields are left as they are
+        ("skipped"), and so are buyers whose profile shows questionnaire
+        answers from before they were logged ("missing_answers").
+        """
+        replays = {}
+        stored_scores = {}
+        incomplete = set()
+        for transaction in db.iter_transactions():
+            buyer = transaction.get("buyer")
+            if "sphere" not in transaction:
+                incomplete.add(buyer)
+                continue
+            if buyer not in replays:
+                record = db.load_user(buyer)
+                replays[buyer] = None
+                if record is not None:
+                    user = User.from_dict(record)
+                    stored_scores[buyer] = dict(user.sphere_scores)
+                    user.reset_preferences()
+                    replays[buyer] = ProfileReplay(user, user.interest_answers)
+            if replays[buyer] is not None:
+                replays[buyer].apply(transaction)
         
-        if user.initial_influence > 0.2:
-            age_group = user._get_age_group()
-            
-            if age_group == "0-13":
-                decay = 0.98
-            elif age_group == "14-18":
-                decay = 0.92
-            elif age_group == "19-30":
-                decay = 0.90
-            elif age_group == "31-50":
-                decay = 0.93
-            else:
-                decay = 0.96
-            
-            user.initial_influence *= decay
+        rebuilt = purchases = missing_answers = 0
+        for buyer, replay in replays.items():
+            if replay is None or buyer in incomplete:
+                continue
+            if ProfileReplay.answers_missing(replay.user, stored_scores[buyer], replay.sphere_purchases):
+                missing_answers += 1
+                continue
+            db.save_user(replay.finish().to_dict())
+            rebuilt += 1
+            purchases += replay.purchases
+        return {"rebuilt": rebuilt, "purchases": purchases, "skipped": len(incomplete),
+                "missing_answers": missing_answers}
+
+
+class CandidateGenerator:
+    """
+    Candidate-generation stage for get_recommendations: rather than scoring
+    the whole catalog, take a bounded set from the catalog indexes and score
+    only those matrix rows. Candidates are, per sphere, up to per_sphere
+    products from the criteria buckets (quality, price level, delivery) the
+    user scores highest, then up to per_source products from each of the
+    user's top_tags best tags and top_types best types, strongest preference
+    first, until max_candidates is reached. Within a bucket, tag or type,
+    products are taken in order of a neutral-profile score (decay applied),
+    computed once per catalog version and decay step. Tags and types on more
+    than max_share of the catalog don't narrow anything down and are
+    skipped. Work grows with the budgets, not the catalog.
+    """
+    
+    def __init__(self, top_tags: int = 20, top_types: int = 10, per_sphere: int = 40,
+                 max_share: float = 0.1, per_source: int = 100, max_candidates: int = 2000):
+        self.top_tags = top_tags
+        self.top_types = top_types
+        self.per_sphere = per_sphere
+        self.max_share = max_share
+        self.per_source = per_source
+        self.max_candidates = max_candidates
+        self._ranked = (None, {})  # ((catalog version, decay epoch), {source: best products})
+    
+    def _ranked_sources(self, catalog: 'ProductCatalog') -> Dict:
+        """
+        Cache of each source's best products by neutral-profile score,
+        emptied when the catalog or decay changes
+        """
+        key = (catalog.version, SPHERE_DECAY_CONFIG["epoch"])
+        cached_key, ranked = self._ranked
+        if cached_key != key:
+            ranked = {}
+            self._ranked = (key, ranked)
+        return ranked
+    
+    @staticmethod
+    def _neutral_scores(catalog: 'ProductCatalog', ranked: Dict) -> np.ndarray:
+        scores = ranked.get("neutral")
+        if scores is None:
+            neutral = _neutral_user()
+            scores = ranked["neutral"] = catalog.matrix().score(neutral, ScoringContext(neutral, decay=catalog.decay))
+        return scores
+    
+    def _best(self, catalog: 'ProductCatalog', ranked: Dict, source: Tuple, products, limit: int) -> List[Dict]:
+        """Up to limit of a source's products, best neutral score first (cached per source)"""
+        best = ranked.get(source)
+        if best is None:
+            products = products()
+            if len(products) > limit:
+                matrix = catalog.matrix()
+                rows = matrix.rows_for(p["id"] for p in products)
+                scores = self._neutral_scores(catalog, ranked)
+                products = [matrix.products[row] for row in top_rows(rows, scores[rows], limit)]
+            best = ranked[source] = products
+        return best
+    
+    def generate(self, user: User, catalog: 'ProductCatalog') -> List[Dict]:
+        """Candidate products for user (at most max_candidates), in id order"""
+        ranked = self._ranked_sources(catalog)
+        candidates = {}
         
-        for s in user.sphere_scores:
-            if s != sphere:
-                user.sphere_scores[s] = max(0.3, user.sphere_scores[s] * 0.98)
+        def take(products: List[Dict]) -> bool:
+            """Add products up to the total budget; False once it is reached"""
+            for p in products[:self.max_candidates - len(candidates)]:
+                candidates[p["id"]] = p
+            return len(candidates) < self.max_candidates
         
-        for tag in product.get("tags", []):
-            if tag in user.tag_scores:
-                user.tag_scores[tag] = min(user.tag_scores[tag] + 0.15, MAX_TAG_SCORE)
-            else:
-                user.tag_scores[tag] = 0.15
+        criteria = user.criteria_scores
+        buckets = sorted(
+            ((q, p, d) for q in QUALITY_CRITERIA for p in PRICE_CRITERIA for d in DELIVERY_CRITERIA),
+            key=lambda c: -(criteria.get(c[0], 0.1) * 0.15 + criteria.get(c[1], 0.1) * 0.15 +
+                            criteria.get(c[2], 0.1) * 0.10)
+        )
+        for sphere in catalog.spheres():
+            taken = 0
+            for bucket in buckets:
+                if taken >= self.per_sphere:
+                    break
+                best = self._best(catalog, ranked, ("criteria", sphere, *bucket),
+                                  partial(catalog.by_criteria, sphere, *bucket), self.per_sphere)
+                if not take(best[:self.per_sphere - taken]):
+                    return self._in_id_order(candidates)
+                taken += len(best)
         
-        product_type = product["type"]
-        if product_type in user.type_scores:
-            user.type_scores[product_type] = min(user.type_scores[product_type] + 0.3, MAX_TYPE_SCORE)
-        else:
-            user.type_scores[product_type] = 0.3
+        max_products = self.max_share * len(catalog)
+        tags = (tag for tag in user.tag_scores if catalog.tag_count(tag) <= max_products)
+        types = (t for t in user.type_scores if catalog.type_count(t) <= max_products)
+        sources = [(user.tag_scores[tag], ("tag", tag), partial(catalog.by_tag, tag))
+                   for tag in heapq.nlargest(self.top_tags, tags, key=user.tag_scores.get)]
+        sources += [(user.type_scores[t], ("type", t), partial(catalog.by_type, t))
+                    for t in heapq.nlargest(self.top_types, types, key=user.type_scores.get)]
+        sources.sort(key=lambda source: -source[0])
+        for _, source, products in sources:
+            if not take(self._best(catalog, ranked, source, products, self.per_source)):
+                break
+        return self._in_id_order(candidates)
+    
+    @staticmethod
+    def _in_id_order(candidates: Dict[int, Dict]) -> List[Dict]:
+        return [candidates[product_id] for product_id in sorted(candidates)]
+    
+    def scaled(self, factor: int) -> 'CandidateGenerator':
+        """Generator with every budget multiplied by factor"""
+        return CandidateGenerator(self.top_tags * factor, self.top_types * factor,
+                                  self.per_sphere * factor, self.max_share,
+                                  self.per_source * factor, self.max_candidates * factor)
+    
+    def recall(self, user: User, catalog: 'ProductCatalog', count: int = 30, clock=datetime.now) -> float:
+        """Share of the exhaustive recommendations that candidate scoring also returns"""
+        now = clock()
+        exact = RecommendationEngine.get_recommendations(user, catalog, count, clock=lambda: now)
+        if not exact:
+            return 1.0
+        approx = RecommendationEngine.get_recommendations(user, catalog, count, clock=lambda: now,
+                                                          candidates=self)
+        return len({p["id"] for p in exact} & {p["id"] for p in approx}) / len(exact)
+    
+    def calibrate(self, users: List[User], catalog: 'ProductCatalog', recall_target: float = 0.95,
+                  count: int = 30, max_factor: int = 64) -> 'CandidateGenerator':
+        """
+        Smallest doubling of the budgets whose mean recall over users reaches
+        recall_target (or the max_factor-times generator if none does).
+        """
+        factor = 1
+        while True:
+            generator = self.scaled(factor)
+            if not users or factor >= max_factor:
+                return generator
+            mean_recall = sum(generator.recall(user, catalog, count) for user in users) / len(users)
+            if mean_recall >= recall_target:
+                return generator
+            factor *= 2
+
+
+class RecommendationCache:
+    """
+    LRU cache of recommendation lists, one entry per user.
+    An entry is reused while the user's profile version, the catalog version
+    and the decay epoch are unchanged, and until the seasonal period or one of
+    the user's recency windows rolls over. Evicts least recently viewed users
+    beyond max_entries or an estimated max_bytes.
+    """
+    
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 4 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def _stamp(user: User, catalog: 'ProductCatalog', count: int) -> Tuple:
+        return (user.profile_version, catalog.version, SPHERE_DECAY_CONFIG["epoch"], count)
+    
+    @staticmethod
+    def _valid_until(user: User, now: datetime) -> float:
+        """Timestamp at which the seasonal bonus or a recency multiplier can next change"""
+        next_month = datetime(now.year + now.month // 12, now.month % 12 + 1, 1)
+        expiry = next_month.timestamp()
+        for last_purchase in user.last_purchase_date.values():
+            if last_purchase:
+                # days_ago > 30 starts to hold 31 days after the purchase
+                flips = datetime.fromisoformat(last_purchase) + timedelta(days=31)
+                if flips > now:
+                    expiry = min(expiry, flips.timestamp())
+        return expiry
+    
+    def get(self, user: User, catalog: 'ProductCatalog', count: int):
+        """Cached recommendations for user, or None if missing or stale"""
+        entry = self._entries.get(user.username)
+        if (entry is None or entry[0] != self._stamp(user, catalog, count)
+                or datetime.now().timestamp() >= entry[1]):
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(user.username)
+        self.hits += 1
+        return list(entry[2])
+    
+    def put(self, user: User, catalog: 'ProductCatalog', count: int, recommendations: List[Dict]):
+        """Store recommendations computed for user against catalog"""
+        self.invalidate(user.username)
         
-        user.last_purchase_date[sphere] = datetime.now().isoformat()
+        products = tuple(recommendations)
+        size = sys.getsizeof(products) + sys.getsizeof(user.username) + 200
+        self._entries[user.username] = (
+            self._stamp(user, catalog, count), self._valid_until(user, datetime.now()), products, size
+        )
+        self._bytes += size
         
-        cancel_sphere_decay(sphere)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted[3]
+    
+    def invalidate(self, username: str):
+        """Drop the cached entry for username, if any"""
+        entry = self._entries.pop(username, None)
+        if entry is not None:
+            self._bytes -= entry[3]
+    
+    def __len__(self) -> int:
+        return len(self._entries)
 
 
 class TerminalInterface:
     """Terminal-based user interface"""
     
-    def __init__(self):
-        self.db = Database()
+    PAGE_SIZE = 10
+    
+    def __init__(self, db=None):
+        self.db = db if db is not None else Database()
+        self.import_state_file = "import_state.json"
+        self.decay_state_file = "decay_state.bin"
         self.current_user = None
-        self.products = []
+        self.products = ProductCatalog()
         self.recommendations = []
+        self.recommendation_cache = RecommendationCache()
     
     def clear_screen(self):
         """Clear terminal screen"""
         os.system('clear' if os.name != 'nt' else 'cls')
     
+    @staticmethod
+    def header(title: str) -> str:
+        return "\n" + "=" * 60 + f"\n  {title}\n" + "=" * 60 + "\n\n"
+    
     def print_header(self, title: str):
         """Print section header"""
-        print("\n" + "=" * 60)
-        print(f"  {title}")
-        print("=" * 60 + "\n")
+        print(self.header(title), end="")
     
     def print_menu(self, options: List[Tuple[int, str]]):
         """Print menu options"""
@@ -912,6 +3646,62 @@ class TerminalInterface:
             print(f"{num}. {text}")
         print()
     
+    @staticmethod
+    def format_product(number: int, product: Dict, show_sphere: bool = True) -> str:
+        """A numbered product entry of a listing"""
+        if show_sphere:
+            kind = f"   Sphere: {product['sphere']} | Type: {product['type']}\n"
+        else:
+            kind = f"   Type: {product['type']}\n"
+        return (f"{number}. {product['name']}\n{kind}"
+                f"   Quality: {product['quality']} | Price: ${product['price']:.2f}\n"
+                f"   Delivery: {product['delivery']}\n\n")
+    
+    def page_through(self, title: str, fetch_page, show_sphere: bool = True, extra_options=()):
+        """
+        Show a listing one page at a time. fetch_page(cursor, size) returns a
+        Page, so only the shown page is generated, and each page is rendered
+        with a single write. Returns the chosen product, the label of a
+        chosen extra option, or None for Back.
+        """
+        cursors = [None]
+        while True:
+            page = fetch_page(cursors[-1], self.PAGE_SIZE)
+            actions = []
+            if page.next_cursor is not None:
+                actions.append("Next page")
+            if len(cursors) > 1:
+                actions.append("Previous page")
+            actions.extend(extra_options)
+            actions.append("Back")
+            
+            listed = len(page.products)
+            output = [self.header(f"{title} (page {len(cursors)})")]
+            if not page.products:
+                output.append("No products found.\n")
+            output.extend(self.format_product(number, product, show_sphere)
+                          for number, product in enumerate(page.products, 1))
+            output.append("\n")
+            output.extend(f"{number}. {label}\n" for number, label in enumerate(actions, listed + 1))
+            
+            self.clear_screen()
+            sys.stdout.write("".join(output))
+            sys.stdout.flush()
+            
+            choice = self.get_choice(listed + len(actions))
+            if choice <= listed:
+                return page.products[choice - 1]
+            
+            action = actions[choice - listed - 1]
+            if action == "Next page":
+                cursors.append(page.next_cursor)
+            elif action == "Previous page":
+                cursors.pop()
+            elif action == "Back":
+                return None
+            else:
+                return action
+    
     def get_choice(self, max_option: int) -> int:
         """Get user menu choice"""
         while True:
@@ -925,17 +3715,20 @@ class TerminalInterface:
     
     def run(self):
         """Main application loop"""
+        if isinstance(self.db, SQLiteDatabase) and self.db.migrate_if_empty():
+            print(f"Migrated the JSON data into {self.db.path}")
         print("Loading products...")
-        excel_path = "IA_COMP_EXPANDED.xlsx"
-        if os.path.exists(excel_path):
-            self.products = load_products_from_excel(excel_path)
-            self.db.save_products(self.products)
-            print(f"Loaded {len(self.products)} products")
-        else:
-            self.products = self.db.load_products()
-            print(f"Loaded {len(self.products)} products from database")
+        self.products, report = load_catalog(self.db, self.import_state_file,
+                                             decay_state_path=self.decay_state_file)
+        print(f"Loaded {len(self.products)} products from database")
         
-        all_spheres = list(set(p.get("sphere", "") for p in self.products))
+        if report is not None:
+            print(f"Imported {EXCEL_IMPORT_PATH}: {len(report['added'])} added, "
+                  f"{len(report['removed'])} removed, {len(report['changed'])} changed "
+                  f"({len(report['reprocessed_sheets'])} sheets reprocessed, "
+                  f"{len(report['skipped_sheets'])} unchanged)")
+        
+        all_spheres = self.products.spheres()
         start_decay_background_task(self.products, all_spheres)
         
         while True:
@@ -948,36 +3741,39 @@ class TerminalInterface:
                 self.print_menu([
                     (1, "View Recommendations"),
                     (2, "Browse All Products"),
-                    (3, "View My Profile"),
-                    (4, "View Purchase History"),
-                    (5, "Add Product for Sale"),
-                    (6, "Manage My Listings"),
-                    (7, "Replenish Balance"),
-                    (8, "Improve Recommendations"),
-                    (9, "Logout"),
-                    (10, "Exit")
+                    (3, "Search Products"),
+                    (4, "View My Profile"),
+                    (5, "View Purchase History"),
+                    (6, "Add Product for Sale"),
+                    (7, "Manage My Listings"),
+                    (8, "Replenish Balance"),
+                    (9, "Improve Recommendations"),
+                    (10, "Logout"),
+                    (11, "Exit")
                 ])
-                choice = self.get_choice(10)
+                choice = self.get_choice(11)
                 
                 if choice == 1:
                     self.view_recommendations()
                 elif choice == 2:
                     self.browse_products()
                 elif choice == 3:
-                    self.view_profile()
+                    self.search_products()
                 elif choice == 4:
-                    self.view_purchase_history()
+                    self.view_profile()
                 elif choice == 5:
-                    self.add_product()
+                    self.view_purchase_history()
                 elif choice == 6:
-                    self.manage_listings()
+                    self.add_product()
                 elif choice == 7:
-                    self.replenish_balance()
+                    self.manage_listings()
                 elif choice == 8:
-                    self.improve_recommendations()
+                    self.replenish_balance()
                 elif choice == 9:
-                    self.logout()
+                    self.improve_recommendations()
                 elif choice == 10:
+                    self.logout()
+                elif choice == 11:
                     break
             else:
                 self.print_menu([
@@ -994,6 +3790,8 @@ class TerminalInterface:
                 elif choice == 3:
                     break
         
+        self.products.decay.flush()
+        self.db.close()
         print("\nThank you for using the Marketplace! Goodbye!")
     
     def improve_recommendations(self):
@@ -1058,6 +3856,7 @@ class TerminalInterface:
     def process_questionnaire(self, questions):
         """FIXED: Reduced boost from 0.5 to 0.15"""
         user = self.current_user
+        chosen = []
 
         for question, spheres in questions:
             print("\n" + question)
@@ -1066,18 +3865,15 @@ class TerminalInterface:
             answer = self.get_choice(2)
 
             if answer == 1:
-                for sphere in spheres:
-                    if sphere in user.sphere_scores:
-                        user.sphere_scores[sphere] = min(
-                            user.sphere_scores[sphere] + 0.15,
-                            MAX_SPHERE_SCORE
-                        )
-                    else:
-                        user.sphere_scores[sphere] = 0.15
+                chosen.extend(spheres)
 
-        users = self.db.load_users()
-        users[user.username] = user.to_dict()
-        self.db.save_users(users)
+        # kept with the profile so ProfileReplay.rebuild can reapply the answers
+        replay = ProfileReplay(user)
+        replay.boost(chosen)
+        replay.finish()
+        if chosen:
+            user.interest_answers.append({"spheres": chosen, "date": datetime.now().isoformat()})
+        self.db.save_user(user.to_dict())
 
         print("\nYour preferences were updated successfully!")
         input("\nPress Enter to continue...")
@@ -1087,14 +3883,12 @@ class TerminalInterface:
         self.clear_screen()
         self.print_header("REGISTRATION")
     
-        users = self.db.load_users()
-    
         while True:
             username = input("Enter username: ").strip()
             if not username or username.isdigit():
                 print("Username cannot be empty or number")
                 continue
-            if username in users:
+            if self.db.user_exists(username):
                 print("Username already exists")
                 continue
             break
@@ -1147,8 +3941,7 @@ class TerminalInterface:
 
         user = User(username, password, age, gender, location, balance)
 
-        users[username] = user.to_dict()
-        self.db.save_users(users)
+        self.db.save_user(user.to_dict())
         
         print(f"\nRegistration successful! Welcome, {username}!")
         input("\nPress Enter to continue...")
@@ -1158,10 +3951,9 @@ class TerminalInterface:
         self.clear_screen()
         self.print_header("LOGIN")
         
-        users = self.db.load_users()
-        
         username = input("Enter username: ").strip()
-        if username not in users:
+        record = self.db.load_user(username)
+        if record is None:
             print("Username not found")
             input("\nPress Enter to continue...")
             return
@@ -1169,20 +3961,18 @@ class TerminalInterface:
         password = input("Enter password: ").strip()
         password_hash = hashlib.sha256(password.encode()).hexdigest()
         
-        if users[username]["password_hash"] != password_hash:
+        if record["password_hash"] != password_hash:
             print("Incorrect password")
             input("\nPress Enter to continue...")
             return
         
-        self.current_user = User.from_dict(users[username])
+        self.current_user = User.from_dict(record)
         print(f"\nWelcome back, {username}!")
         input("\nPress Enter to continue...")
     
     def logout(self):
         """User logout"""
-        users = self.db.load_users()
-        users[self.current_user.username] = self.current_user.to_dict()
-        self.db.save_users(users)
+        self.db.save_user(self.current_user.to_dict())
         
         print(f"\nGoodbye, {self.current_user.username}!")
         self.current_user = None
@@ -1190,45 +3980,39 @@ class TerminalInterface:
     
     def view_recommendations(self):
         """View personalized recommendations"""
-        self.clear_screen()
-        self.print_header("PERSONALIZED RECOMMENDATIONS")
-        
-        self.recommendations = RecommendationEngine.get_recommendations(
-            self.current_user,
-            self.products,
-            30
-        )
+        self.recommendations = self.recommendation_cache.get(self.current_user, self.products, 30)
+        if self.recommendations is None:
+            self.recommendations = RecommendationEngine.get_recommendations(
+                self.current_user,
+                self.products,
+                30
+            )
+            self.recommendation_cache.put(self.current_user, self.products, 30, self.recommendations)
         
         if not self.recommendations:
+            self.clear_screen()
+            self.print_header("PERSONALIZED RECOMMENDATIONS")
             print("No recommendations available at the moment.")
             input("\nPress Enter to continue...")
             return
         
-        for i, product in enumerate(self.recommendations, 1):
-            print(f"{i}. {product['name']}")
-            print(f"   Sphere: {product['sphere']} | Type: {product['type']}")
-            print(f"   Quality: {product['quality']} | Price: ${product['price']:.2f}")
-            print(f"   Delivery: {product['delivery']}")
-            print()
-        
-        print(f"\n{len(self.recommendations) + 1}. Back to Menu")
-        
-        choice = self.get_choice(len(self.recommendations) + 1)
-        
-        if choice <= len(self.recommendations):
-            self.buy_product(self.recommendations[choice - 1], from_recommendations=True)
+        product = self.page_through(
+            "PERSONALIZED RECOMMENDATIONS",
+            lambda cursor, size: Page.of(self.recommendations, cursor or 0, size)
+        )
+        if product is not None:
+            self.buy_product(product, from_recommendations=True)
     
     def browse_products(self):
         """Browse all products"""
         self.clear_screen()
         self.print_header("ALL PRODUCTS")
         
-        spheres = list(set(p["sphere"] for p in self.products))
-        spheres.sort()
+        spheres = self.products.spheres()
         
         print("Select a sphere:")
         for i, sphere in enumerate(spheres, 1):
-            count = len([p for p in self.products if p["sphere"] == sphere])
+            count = self.products.sphere_count(sphere)
             print(f"{i}. {sphere} ({count} products)")
         print(f"\n{len(spheres) + 1}. Back to Menu")
         
@@ -1237,26 +4021,63 @@ class TerminalInterface:
         if choice <= len(spheres):
             self.browse_sphere(spheres[choice - 1])
     
-    def browse_sphere(self, sphere: str):
-        """Browse products in a specific sphere"""
-        self.clear_screen()
-        self.print_header(f"PRODUCTS - {sphere.upper()}")
+    def browse_sphere(self, sphere: str, filters: 'ProductFilter' = None):
+        """Browse products in a specific sphere, optionally narrowed by filters"""
+        chosen = self.page_through(
+            f"PRODUCTS - {sphere.upper()}",
+            lambda cursor, size: self.products.page(cursor or 0, size, sphere, filters),
+            show_sphere=False,
+            extra_options=("Filter",)
+        )
         
-        sphere_products = [p for p in self.products if p["sphere"] == sphere]
+        if chosen == "Filter":
+            self.browse_sphere(sphere, self.ask_filters(sphere))
+        elif chosen is not None:
+            self.buy_product(chosen, from_recommendations=False)
+    
+    def ask_filters(self, sphere: str = None) -> 'ProductFilter':
+        """Ask for an optional price range, quality, price level and delivery"""
+        min_price = max_price = None
+        price_range = input("Price range, e.g. 10-200 (optional): ").strip()
+        if price_range:
+            low, _, high = price_range.partition("-")
+            try:
+                # both bounds or neither: a half-parsed range would filter on the wrong condition
+                min_price, max_price = (float(bound) if bound.strip() else None for bound in (low, high))
+            except ValueError:
+                print("Invalid price range, ignoring it")
         
-        for i, product in enumerate(sphere_products, 1):
-            print(f"{i}. {product['name']}")
-            print(f"   Type: {product['type']}")
-            print(f"   Quality: {product['quality']} | Price: ${product['price']:.2f}")
-            print(f"   Delivery: {product['delivery']}")
-            print()
+        chosen = []
+        for title, criteria in (("Quality", QUALITY_CRITERIA), ("Price level", PRICE_CRITERIA),
+                                ("Delivery", DELIVERY_CRITERIA)):
+            print(f"\n{title}:")
+            print("1. Any")
+            for i, criterion in enumerate(criteria, 2):
+                print(f"{i}. {criterion}")
+            choice = self.get_choice(len(criteria) + 1)
+            chosen.append(criteria[choice - 2] if choice > 1 else None)
         
-        print(f"\n{len(sphere_products) + 1}. Back")
+        return ProductFilter(min_price, max_price, sphere, *chosen)
+    
+    def search_products(self):
+        """Search products by name, type, sphere or tag"""
+        self.clear_screen()
+        self.print_header("SEARCH PRODUCTS")
+        
+        query = input("Search for: ").strip()
+        if not query:
+            return
         
-        choice = self.get_choice(len(sphere_products) + 1)
+        filters = self.ask_filters()
         
-        if choice <= len(sphere_products):
-            self.buy_product(sphere_products[choice - 1], from_recommendations=False)
+        results = RecommendationEngine.search(self.current_user, self.products, query, 20, filters)
+        
+        product = self.page_through(
+            f"SEARCH RESULTS - {query.upper()}",
+            lambda cursor, size: Page.of(results, cursor or 0, size)
+        )
+        if product is not None:
+            self.buy_product(product, from_recommendations=False)
     
     def buy_product(self, product: Dict, from_recommendations: bool):
         """Purchase a product"""
@@ -1289,51 +4110,50 @@ class TerminalInterface:
             
             self.current_user.balance -= product["price"]
             
+            seller_record = None
             if product["owner"] != "system":
-                users = self.db.load_users()
-                if product["owner"] in users:
-                    seller = User.from_dict(users[product["owner"]])
+                seller_record = self.db.load_user(product["owner"])
+                if seller_record is not None:
+                    seller = User.from_dict(seller_record)
                     seller.balance += product["price"]
-                    users[product["owner"]] = seller.to_dict()
-                    self.db.save_users(users)
+                    seller_record = seller.to_dict()
             
+            now = datetime.now().isoformat()
             RecommendationEngine.update_profile_after_purchase(
                 self.current_user,
                 product,
-                from_recommendations
+                from_recommendations,
+                now
             )
             
+            features = purchase_features(product, from_recommendations)
             transaction = {
                 "buyer": self.current_user.username,
                 "seller": product["owner"],
                 "product": product["name"],
                 "price": product["price"],
-                "date": datetime.now().isoformat()
+                "date": now,
+                **features
             }
-            self.db.save_transaction(transaction)
             
             purchase_record = {
                 "product_name": product["name"],
-                "sphere": product["sphere"],
-                "type": product["type"],
                 "price": product["price"],
-                "quality": product["quality"],
                 "seller": product["owner"],
-                "date": datetime.now().isoformat()
+                "date": now,
+                **features
             }
             self.current_user.purchase_history.append(purchase_record)
             
-            users = self.db.load_users()
-            users[self.current_user.username] = self.current_user.to_dict()
-            self.db.save_users(users)
-            
-            if "_score" in product:
-                del product["_score"]
-            if "decay_score" in product:
-                del product["decay_score"]
-            
-            self.products = [p for p in self.products if p["id"] != product["id"]]
-            self.db.save_products(self.products)
+            self.products.remove(product["id"])
+            try:
+                self.db.purchase(self.current_user.to_dict(), seller_record,
+                                 product["id"], transaction, self.products)
+            except ValueError:
+                self.current_user = User.from_dict(self.db.load_user(self.current_user.username))
+                print("\nThis product is no longer available.")
+                input("\nPress Enter to continue...")
+                return
             
             print("\nPurchase successful!")
             print(f"New balance: ${self.current_user.balance:.2f}")
@@ -1422,9 +4242,7 @@ class TerminalInterface:
         
         self.current_user.balance += amount
         
-        users = self.db.load_users()
-        users[self.current_user.username] = self.current_user.to_dict()
-        self.db.save_users(users)
+        self.db.save_user(self.current_user.to_dict())
         
         print(f"\n✓ Successfully added ${amount:.2f}")
         print(f"New Balance: ${self.current_user.balance:.2f}")
@@ -1442,7 +4260,7 @@ class TerminalInterface:
             return
         
         print("\nChoose a sphere:")
-        spheres = sorted(set(p["sphere"] for p in self.products))
+        spheres = self.products.spheres()
         for i, sphere in enumerate(spheres, 1):
             print(f"{i}. {sphere}")
         
@@ -1498,7 +4316,7 @@ class TerminalInterface:
         tags_input = input("\nEnter tags (comma-separated, optional): ").strip()
         tags = [t.strip() for t in tags_input.split(",")] if tags_input else ["user_product"]
         
-        new_product_id = max([p["id"] for p in self.products], default=0) + 1
+        new_product_id = self.products.next_id()
         
         new_product = {
             "id": new_product_id,
@@ -1513,8 +4331,8 @@ class TerminalInterface:
             "tags": tags
         }
         
-        self.products.append(new_product)
-        self.db.save_products(self.products)
+        self.products.add(new_product)
+        self.db.add_product(new_product, self.products)
         
         print(f"\n✓ Product '{product_name}' successfully listed for sale!")
         print(f"Price: ${price:.2f}")
@@ -1525,7 +4343,7 @@ class TerminalInterface:
         self.clear_screen()
         self.print_header("MY PRODUCT LISTINGS")
         
-        my_products = [p for p in self.products if p["owner"] == self.current_user.username]
+        my_products = self.products.by_owner(self.current_user.username)
         
         if not my_products:
             print("You haven't listed any products for sale.")
@@ -1552,8 +4370,8 @@ class TerminalInterface:
             
             confirm = self.get_choice(2)
             if confirm == 1:
-                self.products = [p for p in self.products if p["id"] != product_to_withdraw["id"]]
-                self.db.save_products(self.products)
+                self.products.remove(product_to_withdraw["id"])
+                self.db.remove_product(product_to_withdraw["id"], self.products)
                 
                 print(f"✓ Product withdrawn from sale!")
                 input("\nPress Enter to continue...")
@@ -1562,6 +4380,536 @@ class TerminalInterface:
 
 
 
+_MISSING = object()
+
+
+class CatalogGate:
+    """
+    Reader/writer gate over the shared catalog in server mode. Any number of
+    scoring jobs may read the catalog at once; a mutation waits for them and
+    runs alone. Waiting writers hold back new readers so purchases aren't starved.
+    """
+    
+    def __init__(self):
+        self._condition = asyncio.Condition()
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writing = False
+    
+    @asynccontextmanager
+    async def read(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._writing and not self._writers_waiting)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+    
+    @asynccontextmanager
+    async def write(self):
+        async with self._condition:
+            self._writers_waiting += 1
+            try:
+                await self._condition.wait_for(lambda: not self._writing and not self._readers)
+            finally:
+                self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+class MarketplaceServer:
+    """
+    asyncio server for many concurrent sessions over a line-delimited JSON
+    protocol. Each request is one JSON object with an "op" and its arguments;
+    each reply is {"ok": true, ...} or {"ok": false, "error": "..."}.
+    A connection is a session. Sessions share one catalog, recommendation
+    cache and set of logged-in User objects; scoring runs in a thread pool
+    so the event loop keeps serving other sessions meanwhile.
+    """
+    
+    OPS = ("register", "login", "logout", "recommendations", "spheres", "browse", "search", "buy",
+           "add_product", "listings", "withdraw", "profile", "history", "replenish")
+    
+    def __init__(self, db=None, host: str = "127.0.0.1", port: int = 8765, workers: int = None):
+        self.db = db if db is not None else Database()
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.import_state_file = "import_state.json"
+        self.decay_state_file = "decay_state.bin"
+        self.products = ProductCatalog()
+        self.recommendation_cache = RecommendationCache()
+        self.gate = CatalogGate()
+        self._db_lock = None
+        self._executor = None
+        self._server = None
+        self._users: Dict[str, User] = {}
+        self._user_sessions: Dict[str, int] = {}
+        self._user_locks: Dict[str, asyncio.Lock] = {}
+        self._sessions: Set[asyncio.Task] = set()
+    
+    async def start(self):
+        """Load the catalog, start decay and the scoring pool, and begin listening"""
+        if isinstance(self.db, SQLiteDatabase) and self.db.migrate_if_empty():
+            print(f"Migrated the JSON data into {self.db.path}")
+        self.products, _ = load_catalog(self.db, self.import_state_file,
+                                        decay_state_path=self.decay_state_file)
+        self.products.matrix()  # build once here, not concurrently in the first scoring jobs
+        self.products.search_index()
+        start_decay_background_task(self.products, self.products.spheres())
+        
+        self._db_lock = asyncio.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scoring")
+        self._server = await asyncio.start_server(self._handle_session, self.host, self.port)
+        return self._server
+    
+    async def close(self):
+        """Stop listening, end open sessions, then persist decay state and flush the database"""
+        if self._server is not None:
+            self._server.close()
+            # connected sessions save their user before the database closes
+            for task in self._sessions:
+                task.cancel()
+            await asyncio.gather(*self._sessions, return_exceptions=True)
+            await self._server.wait_closed()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self.products.decay.flush()
+        self.db.close()
+    
+    async def run(self):
+        """Serve until cancelled (e.g. Ctrl+C)"""
+        server = await self.start()
+        print(f"Serving {len(self.products)} products on {self.host}:{self.port}")
+        try:
+            await server.serve_forever()
+        finally:
+            await self.close()
+    
+    async def _db_call(self, method, *args):
+        """Run a blocking database call off the event loop, one at a time"""
+        async with self._db_lock:
+            return await asyncio.to_thread(method, *args)
+    
+    async def _handle_session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = {"user": None, "recommended": set()}
+        task = asyncio.current_task()
+        self._sessions.add(task)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = await self.dispatch(session, line)
+                writer.write(json.dumps(reply, ensure_ascii=False).encode('utf-8') + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except asyncio.CancelledError:
+            # server shutdown; ending quietly keeps asyncio from logging the cancellation
+            pass
+        finally:
+            if session["user"] is not None:
+                await self._release_user(session)
+            writer.close()
+            self._sessions.discard(task)
+    
+    async def dispatch(self, session: Dict, line: bytes) -> Dict:
+        """Handle one request line for session and return the reply"""
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("Request must be a JSON object")
+            op = request.get("op")
+            if op not in self.OPS:
+                raise ValueError(f"Unknown op: {op}")
+            if op not in ("register", "login") and session["user"] is None:
+                raise ValueError("Not logged in")
+            result = await getattr(self, "_op_" + op)(session, request)
+        except ValueError as e:
+            return {"ok": False, "error": str(e)}
+        except Exception as e:
+            # a malformed request (e.g. Infinity, unhashable filter values) must not drop the session
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        return {"ok": True, **result}
+    
+    @staticmethod
+    def _arg(request: Dict, name: str, kind=str, default=_MISSING):
+        """Argument name from request converted to kind; ValueError if missing or invalid"""
+        if name not in request:
+            if default is _MISSING:
+                raise ValueError(f"Missing argument: {name}")
+            return default
+        try:
+            return kind(request[name])
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid {name}: {request[name]!r}") from None
+    
+    def _filter_arg(self, request: Dict, sphere: str = None):
+        """
+        ProductFilter from the request's min_price, max_price, quality,
+        price_level and delivery, limited to sphere; None without conditions
+        """
+        fields = {name: self._arg(request, name, float, None) for name in ("min_price", "max_price")}
+        for name in ("quality", "price_level", "delivery"):
+            value = request.get(name)
+            if value is not None and not isinstance(value, (str, list)):
+                raise ValueError(f"Invalid {name}: {value!r}")
+            fields[name] = value
+        if all(value is None for value in fields.values()):
+            return None  # a sphere alone is served lazily from the catalog's sphere index
+        return ProductFilter(sphere=sphere, **fields)
+    
+    @staticmethod
+    def _product_view(product: Dict) -> Dict:
+        view = dict(product)
+        view["tags"] = list(view["tags"])
+        return view
+    
+    def _user_lock(self, username: str) -> asyncio.Lock:
+        """Lock serializing loading, attaching and releasing one user's shared User"""
+        return self._user_locks.setdefault(username, asyncio.Lock())
+    
+    async def _acquire_user(self, session: Dict, username: str):
+        """Attach the shared User for username to session, loading it if no session has it"""
+        async with self._user_lock(username):
+            user = self._users.get(username)
+            if user is None:
+                record = await self._db_call(self.db.load_user, username)
+                if record is None:
+                    raise ValueError("Username not found")
+                user = self._users[username] = User.from_dict(record)
+            self._user_sessions[username] = self._user_sessions.get(username, 0) + 1
+        session["user"] = user
+        session["recommended"] = set()
+    
+    async def _release_user(self, session: Dict):
+        """Save the session's user and drop it once no other session uses it"""
+        user = session["user"]
+        session["user"] = None
+        session["recommended"] = set()
+        async with self._user_lock(user.username):
+            await self._db_call(self.db.save_user, user.to_dict())
+            # dropped only once saved, so a login reloading the user sees this session's changes
+            self._user_sessions[user.username] -= 1
+            if not self._user_sessions[user.username]:
+                del self._user_sessions[user.username]
+                del self._users[user.username]
+    
+    async def _op_register(self, session: Dict, request: Dict) -> Dict:
+        username = self._arg(request, "username").strip()
+        password = self._arg(request, "password").strip()
+        age = self._arg(request, "age", int)
+        gender = self._arg(request, "gender")
+        location = self._arg(request, "location")
+        balance = self._arg(request, "balance", float)
+        
+        if not username or username.isdigit():
+            raise ValueError("Username cannot be empty or number")
+        if not password:
+            raise ValueError("Password cannot be empty")
+        if age < 1 or age > 120:
+            raise ValueError("Please enter a valid age")
+        if gender not in GENDER_MODIFIERS:
+            raise ValueError(f"Unknown gender: {gender}")
+        if location not in LOCATION_MODIFIERS:
+            raise ValueError(f"Unknown location: {location}")
+        if balance < 0:
+            raise ValueError("You cannot have a negative balance.")
+        
+        async with self._db_lock:
+            if await asyncio.to_thread(self.db.user_exists, username):
+                raise ValueError("Username already exists")
+            user = User(username, password, age, gender, location, balance)
+            await asyncio.to_thread(self.db.save_user, user.to_dict())
+        return {"username": username}
+    
+    async def _op_login(self, session: Dict, request: Dict) -> Dict:
+        username = self._arg(request, "username").strip()
+        password = self._arg(request, "password").strip()
+        
+        user = self._users.get(username)
+        if user is not None:
+            password_hash = user.password_hash
+        else:
+            record = await self._db_call(self.db.load_user, username)
+            if record is None:
+                raise ValueError("Username not found")
+            password_hash = record["password_hash"]
+        if password_hash != hashlib.sha256(password.encode()).hexdigest():
+            raise ValueError("Incorrect password")
+        
+        if session["user"] is not None:
+            await self._release_user(session)
+        await self._acquire_user(session, username)
+        return {"username": username, "balance": session["user"].balance}
+    
+    async def _op_logout(self, session: Dict, request: Dict) -> Dict:
+        await self._release_user(session)
+        return {}
+    
+    async def _op_recommendations(self, session: Dict, request: Dict) -> Dict:
+        user = session["user"]
+        count = self._arg(request, "count", int, 30)
+        if count < 1 or count > 100:
+            raise ValueError("count must be between 1 and 100")
+        
+        filters = self._filter_arg(request)
+        
+        if "cursor" in request:
+            return await self._recommendation_page(session, request, count, filters)
+        
+        recommendations = None
+        if filters is None:
+            recommendations = self.recommendation_cache.get(user, self.products, count)
+        if recommendations is None:
+            profile_version = user.profile_version
+            async with self.gate.read():
+                recommendations = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, partial(RecommendationEngine.get_recommendations,
+                                            user, self.products, count, filters=filters)
+                )
+                if filters is None and user.profile_version == profile_version:
+                    self.recommendation_cache.put(user, self.products, count, recommendations)
+        
+        session["recommended"] = {p["id"] for p in recommendations}
+        return {"products": [self._product_view(p) for p in recommendations]}
+    
+    async def _recommendation_page(self, session: Dict, request: Dict, count: int, filters) -> Dict:
+        """Score-ordered page after request["cursor"] (null for the first page)"""
+        cursor = request["cursor"]
+        if cursor is not None:
+            try:
+                last_score, last_id = cursor
+                cursor = (float(last_score), int(last_id))
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid cursor: {cursor!r}") from None
+        
+        async with self.gate.read():
+            page = await asyncio.get_running_loop().run_in_executor(
+                self._executor, partial(RecommendationEngine.recommendation_page,
+                                        session["user"], self.products, count, cursor, filters)
+            )
+        
+        if cursor is None:
+            session["recommended"] = set()
+        session["recommended"].update(p["id"] for p in page.products)
+        return {"products": [self._product_view(p) for p in page.products],
+                "next_cursor": page.next_cursor and list(page.next_cursor)}
+    
+    async def _op_spheres(self, session: Dict, request: Dict) -> Dict:
+        return {"spheres": [{"name": sphere, "count": self.products.sphere_count(sphere)}
+                            for sphere in self.products.spheres()]}
+    
+    async def _op_browse(self, session: Dict, request: Dict) -> Dict:
+        sphere = self._arg(request, "sphere")
+        offset = self._arg(request, "offset", int, 0)
+        limit = self._arg(request, "limit", int, 50)
+        if offset < 0 or limit < 1 or limit > 500:
+            raise ValueError("offset must be >= 0 and limit between 1 and 500")
+        page = self.products.page(offset, limit, sphere, self._filter_arg(request, sphere))
+        return {"products": [self._product_view(p) for p in page.products],
+                "next_offset": page.next_cursor}
+    
+    async def _op_search(self, session: Dict, request: Dict) -> Dict:
+        query = self._arg(request, "query")
+        count = self._arg(request, "count", int, 20)
+        results = RecommendationEngine.search(session["user"], self.products, query, count,
+                                              self._filter_arg(request))
+        return {"products": [self._product_view(p) for p in results]}
+    
+    async def _op_buy(self, session: Dict, request: Dict) -> Dict:
+        user = session["user"]
+        product_id = self._arg(request, "product_id", int)
+        
+        async with self.gate.write():
+            product = self.products.get(product_id)
+            if product is None:
+                raise ValueError("This product is no longer available.")
+            if product["owner"] == user.username:
+                raise ValueError("You cannot buy your own product!")
+            if user.balance < product["price"]:
+                raise ValueError("Insufficient balance!")
+            
+            seller = None
+            if product["owner"] != "system":
+                seller = self._users.get(product["owner"])
+                if seller is None:
+                    seller_record = await self._db_call(self.db.load_user, product["owner"])
+                    if seller_record is not None:
+                        seller = User.from_dict(seller_record)
+            
+            user.balance -= product["price"]
+            if seller is not None:
+                seller.balance += product["price"]
+            
+            now = datetime.now().isoformat()
+            recommended = product_id in session["recommended"]
+            RecommendationEngine.update_profile_after_purchase(user, product, recommended, now)
+            
+            features = purchase_features(product, recommended)
+            transaction = {
+                "buyer": user.username,
+                "seller": product["owner"],
+                "product": product["name"],
+                "price": product["price"],
+                "date": now,
+                **features
+            }
+            user.purchase_history.append({
+                "product_name": product["name"],
+                "price": product["price"],
+                "seller": product["owner"],
+                "date": now,
+                **features
+            })
+            
+            self.products.remove(product_id)
+            try:
+                await self._db_call(self.db.purchase, user.to_dict(),
+                                    seller.to_dict() if seller is not None else None,
+                                    product_id, transaction, self.products)
+            except ValueError:
+                # roll the shared User objects back to what was persisted
+                for account in (user, seller):
+                    if account is not None and account.username in self._users:
+                        record = await self._db_call(self.db.load_user, account.username)
+                        vars(account).update(vars(User.from_dict(record)))
+                raise ValueError("This product is no longer available.") from None
+        
+        return {"balance": user.balance}
+    
+    async def _op_add_product(self, session: Dict, request: Dict) -> Dict:
+        user = session["user"]
+        name = self._arg(request, "name").strip()
+        sphere = self._arg(request, "sphere")
+        product_type = self._arg(request, "type")
+        quality = self._arg(request, "quality")
+        price_level = self._arg(request, "price_level")
+        delivery = self._arg(request, "delivery")
+        price = self._arg(request, "price", float)
+        tags = [str(t).strip() for t in request.get("tags") or ()] or ["user_product"]
+        
+        if not name:
+            raise ValueError("Product name cannot be empty!")
+        if sphere not in self.products.spheres():
+            raise ValueError(f"Unknown sphere: {sphere}")
+        if product_type not in SPHERE_TYPES.get(sphere, ["General"]):
+            raise ValueError(f"Unknown type for {sphere}: {product_type}")
+        if quality not in QUALITY_CRITERIA:
+            raise ValueError(f"Unknown quality: {quality}")
+        if price_level not in PRICE_CRITERIA:
+            raise ValueError(f"Unknown price level: {price_level}")
+        if delivery not in DELIVERY_CRITERIA:
+            raise ValueError(f"Unknown delivery: {delivery}")
+        if price <= 0 or price > 100000:
+            raise ValueError("Price must be positive and at most $100,000")
+        
+        async with self.gate.write():
+            new_product = {
+                "id": self.products.next_id(),
+                "name": name,
+                "sphere": sphere,
+                "type": product_type,
+                "price": price,
+                "owner": user.username,
+                "quality": quality,
+                "price_level": price_level,
+                "delivery": delivery,
+                "tags": tags
+            }
+            self.products.add(new_product)
+            await self._db_call(self.db.add_product, new_product, self.products)
+        return {"product": new_product}
+    
+    async def _op_listings(self, session: Dict, request: Dict) -> Dict:
+        return {"products": [self._product_view(p)
+                             for p in self.products.by_owner(session["user"].username)]}
+    
+    async def _op_withdraw(self, session: Dict, request: Dict) -> Dict:
+        product_id = self._arg(request, "product_id", int)
+        
+        async with self.gate.write():
+            product = self.products.get(product_id)
+            if product is None or product["owner"] != session["user"].username:
+                raise ValueError("You have no such listing")
+            self.products.remove(product_id)
+            await self._db_call(self.db.remove_product, product_id, self.products)
+        return {}
+    
+    async def _op_profile(self, session: Dict, request: Dict) -> Dict:
+        user = session["user"]
+        return {
+            "username": user.username,
+            "age": user.age,
+            "gender": user.gender,
+            "location": user.location,
+            "balance": user.balance,
+            "initial_influence": user.initial_influence,
+            "sphere_scores": user.sphere_scores,
+            "criteria_scores": user.criteria_scores
+        }
+    
+    async def _op_history(self, session: Dict, request: Dict) -> Dict:
+        return {"purchases": session["user"].purchase_history}
+    
+    async def _op_replenish(self, session: Dict, request: Dict) -> Dict:
+        user = session["user"]
+        amount = self._arg(request, "amount", float)
+        if amount <= 0:
+            raise ValueError("Amount must be positive!")
+        if amount > 1000000:
+            raise ValueError("Amount is too large (max $1,000,000)")
+        
+        user.balance += amount
+        await self._db_call(self.db.save_user, user.to_dict())
+        return {"balance": user.balance}
+
+
 if __name__ == "__main__":
-    app = TerminalInterface()
-    app.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Marketplace recommendation system")
+    parser.add_argument("--serve", action="store_true",
+                        help="run the multi-session JSON server instead of the terminal interface")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=None, help="scoring threads")
+    parser.add_argument("--rebuild-profiles", action="store_true",
+                        help="recompute every buyer's profile from the transaction log and exit")
+    parser.add_argument("--sqlite", metavar="PATH", default=None,
+                        help="store data in this SQLite file instead of JSON files; an empty "
+                             "database is first filled from the JSON data in the working directory")
+    args = parser.parse_args()
+    
+    def open_database():
+        if args.sqlite is None:
+            return None
+        return SQLiteDatabase(args.sqlite)
+    
+    if args.rebuild_profiles:
+        database = open_database()
+        if database is None:
+            database = Database()
+        else:
+            database.migrate_if_empty()
+        report = ProfileReplay.rebuild_all(database)
+        database.close()
+        print(f"Rebuilt {report['rebuilt']} profiles from {report['purchases']} purchases; "
+              f"{report['skipped']} buyers with older transactions and {report['missing_answers']} "
+              f"with unlogged questionnaire answers left unchanged")
+    elif args.serve:
+        try:
+            asyncio.run(MarketplaceServer(open_database(), host=args.host, port=args.port,
+                                          workers=args.workers).run())
+        except KeyboardInterrupt:
+            pass
+    else:
+        app = TerminalInterface(open_database())
+        app.run()
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""ProfileReplay must end in the same profile as learning purchases one call at a time"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recommendation_system import (  # noqa: E402
+    DELIVERY_CRITERIA, PRICE_CRITERIA, QUALITY_CRITERIA, SPHERE_TYPES,
+    Database, ProfileReplay, RecommendationEngine, User, purchase_features
+)
+
+SPHERES = ["Electronics", "Gaming", "Perfume", "Sports and Health"]
+
+
+def make_products():
+    products = []
+    for i in range(40):
+        sphere = SPHERES[i % len(SPHERES)]
+        products.append({
+            "id": i + 1,
+            "name": f"Product {i + 1}",
+            "sphere": sphere,
+            "type": SPHERE_TYPES[sphere][i % 3],
+            "price": 10.0 + i,
+            "quality": QUALITY_CRITERIA[i % 3],
+            "price_level": PRICE_CRITERIA[(i // 3) % 3],
+            "delivery": DELIVERY_CRITERIA[(i // 9) % 3],
+            "tags": ["daily", "portable"] if i % 5 else ["wireless"],
+            "owner": "system",
+        })
+    return products
+
+
+def purchases(products, n=60):
+    """A stream of purchases with every third one recommended, a day apart"""
+    stream = []
+    for i in range(n):
+        purchase = purchase_features(products[(i * 7) % len(products)], i % 3 == 0)
+        purchase["date"] = f"2024-{1 + i // 28:02d}-{1 + i % 28:02d}T10:00:00"
+        stream.append(purchase)
+    return stream
+
+
+def profile(user):
+    record = user.to_dict()
+    del record["purchase_history"], record["interest_answers"]
+    return record
+
+
+def per_call(user, stream, answers=()):
+    """Learn stream one update_profile_after_purchase call at a time, answering on the way"""
+    events = sorted([(a["date"], 0, a) for a in answers] + [(p["date"], 1, p) for p in stream],
+                    key=lambda event: event[:2])
+    for _, kind, event in events:
+        if kind == 0:
+            replay = ProfileReplay(user)
+            replay.boost(event["spheres"])
+            replay.finish()
+        else:
+            RecommendationEngine.update_profile_after_purchase(user, event, event["recommended"], event["date"])
+    return user
+
+
+@pytest.mark.parametrize("n", [0, 1, 60, 300])
+def test_replay_matches_per_call(n):
+    stream = purchases(make_products(), n)
+    expected = per_call(User("a", "pw", 25, "female", "big_city", 0), stream)
+    replayed = ProfileReplay.replay(User("a", "pw", 25, "female", "big_city", 0), stream)
+    assert profile(replayed) == profile(expected)
+
+
+def test_rebuild_matches_per_call_with_answers():
+    stream = purchases(make_products())
+    answers = [{"spheres": ["Perfume", "Gaming"], "date": "2024-01-05T12:00:00"},
+               {"spheres": ["Electronics"], "date": "2024-02-10T12:00:00"}]
+    expected = per_call(User("a", "pw", 40, "male", "village", 0), stream, answers)
+
+    user = User("a", "pw", 40, "male", "village", 0)
+    user.purchase_history = stream
+    user.interest_answers = answers
+    user.sphere_scores["Perfume"] += 1.0  # stale learning, replaced by the rebuild
+    assert profile(ProfileReplay.rebuild(user)) == profile(expected)
+
+
+def test_rebuild_refuses_unlogged_answers():
+    user = User("a", "pw", 25, "female", "big_city", 0)
+    replay = ProfileReplay(user)
+    replay.boost(["Perfume", "Perfume", "Perfume"])  # answered before interest_answers existed
+    replay.finish()
+    before = profile(user)
+    with pytest.raises(ValueError):
+        ProfileReplay.rebuild(user)
+    assert profile(user) == before
+
+
+def test_rebuild_all_matches_per_call(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    products = make_products()
+    db = Database(write_delay=0)
+    try:
+        expected = {}
+        for name, age, stream in [("logged", 25, purchases(products, 40)), ("unlogged", 60, purchases(products, 5))]:
+            user = User(name, "pw", age, "female", "small_city", 0)
+            if name == "unlogged":
+                replay = ProfileReplay(user)
+                replay.boost(["Perfume"] * 10)
+                replay.finish()
+            per_call(user, stream)
+            for purchase in stream:
+                db.save_transaction({"buyer": name, "seller": "system", "product": "x", "price": 1.0, **purchase})
+            db.save_user(user.to_dict())
+            expected[name] = profile(user)
+
+        # a rule change since: rebuild must recompute the logged buyer, but leave the unlogged one alone
+        stale = User.from_dict(db.load_user("logged"))
+        stale.sphere_scores["Gaming"] = 0.3
+        db.save_user(stale.to_dict())
+
+        report = ProfileReplay.rebuild_all(db)
+        assert report["rebuilt"] == 1 and report["missing_answers"] == 1
+        for name in expected:
+            assert profile(User.from_dict(db.load_user(name))) == expected[name]
+    finally:
+        db.close()
+
+
+def test_rebuild_refuses_answers_partly_logged():
+    user = User("a", "pw", 25, "female", "big_city", 0)
+    replay = ProfileReplay(user)
+    replay.boost(["Perfume"] * 5)  # before the log
+    replay.finish()
+    per_call(user, [], [{"spheres": ["Perfume"], "date": "2024-01-01T00:00:00"}])
+    user.interest_answers = [{"spheres": ["Perfume"], "date": "2024-01-01T00:00:00"}]
+    with pytest.raises(ValueError):
+        ProfileReplay.rebuild(user)
@@ -0,0 +1,86 @@
+"""Heap, sort and vectorized selection must return the same recommendations"""
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recommendation_system import (  # noqa: E402
+    DELIVERY_CRITERIA, PRICE_CRITERIA, QUALITY_CRITERIA,
+    ProductCatalog, ProductMatrix, RecommendationEngine, User
+)
+
+CLOCK = lambda: datetime(2024, 3, 15, 12, 0)  # noqa: E731
+SPHERES = ["Electronics", "Gaming", "Books", "Sports and Health", "Kitchen Products", "Toys"]
+
+
+def make_products():
+    """A catalog full of ties: every attribute combination appears several times"""
+    products = []
+    for i in range(600):
+        products.append({
+            "id": i + 1,
+            "name": f"Product {i + 1}",
+            "sphere": SPHERES[i % len(SPHERES)],
+            "type": f"Type {i % 4}",
+            "price": 10.0 + i % 7,
+            "quality": QUALITY_CRITERIA[i % 3],
+            "price_level": PRICE_CRITERIA[(i // 3) % 3],
+            "delivery": DELIVERY_CRITERIA[(i // 9) % 3],
+            "tags": ["daily", "portable"] if i % 5 else ["wireless"],
+            "owner": "system",
+        })
+    return products
+
+
+def make_user(purchases=()):
+    user = User("tester", "secret", 25, "male", "big_city", 1000)
+    for product, when in purchases:
+        RecommendationEngine.update_profile_after_purchase(user, product, False, when)
+    return user
+
+
+@pytest.fixture(scope="module")
+def products():
+    return make_products()
+
+
+@pytest.fixture(scope="module", params=["fresh", "with purchases"])
+def user(request, products):
+    if request.param == "fresh":
+        return make_user()
+    return make_user([(products[3], "2024-03-01T10:00:00"), (products[10], "2024-03-10T10:00:00")])
+
+
+def ids(recommendations):
+    return [p["id"] for p in recommendations]
+
+
+@pytest.mark.parametrize("count", [0, 1, 7, 30, 100])
+def test_heap_matches_sort(products, user, count):
+    heap = RecommendationEngine.get_recommendations(user, products, count, selection="heap", clock=CLOCK)
+    full_sort = RecommendationEngine.get_recommendations(user, products, count, selection="sort", clock=CLOCK)
+    assert ids(heap) == ids(full_sort)
+    assert len(heap) == min(count, len(products))
+
+
+@pytest.mark.parametrize("count", [0, 1, 7, 30, 100])
+def test_vectorized_matches_sort(products, user, count):
+    full_sort = RecommendationEngine.get_recommendations(user, products, count, selection="sort", clock=CLOCK)
+    vectorized = RecommendationEngine.get_recommendations(user, products, count,
+                                                          matrix=ProductMatrix(products), clock=CLOCK)
+    catalog = RecommendationEngine.get_recommendations(user, ProductCatalog(products), count, clock=CLOCK)
+    assert ids(vectorized) == ids(full_sort)
+    assert ids(catalog) == ids(full_sort)
+
+
+@pytest.mark.parametrize("count", [0, 1, 7, 30, 100])
+def test_batch_matches_sort(products, count):
+    users = [make_user(), make_user([(products[3], "2024-03-01T10:00:00")])]
+    users[1].username = "buyer"
+    batch = RecommendationEngine.get_recommendations_batch(users, ProductCatalog(products), count, clock=CLOCK)
+    for user in users:
+        full_sort = RecommendationEngine.get_recommendations(user, products, count, selection="sort", clock=CLOCK)
+        assert ids(batch[user.username]) == ids(full_sort)